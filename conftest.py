@@ -23,6 +23,14 @@ def test_db():
     _drop_db(config)
 
 
+@pytest.fixture
+def clean_db():
+    """Recreate test tables with initial data, for tests that modify them"""
+    config = Config('config.test.ini')
+    _clear_tables(config)
+    _fill_db(config)
+
+
 def _create_db(config):
     connection = get_db_conn(config, with_db=False)
     connection.autocommit = True
@@ -74,6 +82,8 @@ def _clear_tables(config):
                 DROP TABLE IF EXISTS author_archive CASCADE;
                 DROP TABLE IF EXISTS author_book CASCADE;
                 DROP TABLE IF EXISTS author_book_archive CASCADE;
+                DROP TABLE IF EXISTS employee CASCADE;
+                DROP TABLE IF EXISTS employee_archive CASCADE;
             """)
     except Exception as error:
         if not hasattr(error, "pgerror") or "does not exist" not in error.pgerror:
@@ -111,6 +121,13 @@ def _fill_db(config):
                     PRIMARY KEY (author_id, book_id)
                 );
                 
+                CREATE TABLE IF NOT EXISTS employee (
+                    id serial PRIMARY KEY,
+                    name text NOT NULL,
+                    manager_id integer REFERENCES employee (id)
+                );
+                CREATE INDEX IF NOT EXISTS employee_manager_id_idx ON employee (manager_id);
+                
                 INSERT INTO publisher (id, name) VALUES (1, 'O Reilly'), (2, 'Packt'), (3, 'Bloomsbury');
                 INSERT INTO book (id, name, publisher_id) VALUES 
                     (1, 'High Performance Python', 1), 
@@ -128,6 +145,10 @@ def _fill_db(config):
                     (3, 2), (4, 2), 
                     (5, 3), (6, 3), 
                     (7, 4), (7, 5);
+                -- 25 levels chain 1 <- 2 <- ... <- 25, employee 26 reports to 1, employee 27 is a separate root
+                INSERT INTO employee (id, name, manager_id)
+                    SELECT i, 'Employee ' || i, NULLIF(i - 1, 0) FROM generate_series(1, 25) i;
+                INSERT INTO employee (id, name, manager_id) VALUES (26, 'Employee 26', 1), (27, 'Employee 27', NULL);
             """)
     finally:
         connection.close()
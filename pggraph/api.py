@@ -2,25 +2,37 @@
 Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
 Please, see the LICENSE.md file in project's root for full licensing information.
 """
+import io
 import logging
 from argparse import Namespace
-from typing import List, Dict
+from collections import defaultdict
+from typing import List, Dict, Iterator, Callable, Tuple, Optional
 
+from psycopg2._psycopg import cursor
 from psycopg2.extras import DictCursor
 from psycopg2.sql import SQL
 
 from pggraph.db import build_references as br
 from pggraph.config import Config
-from pggraph.db.archiver import Archiver
-from pggraph.db.base import get_db_conn
+from pggraph.db.archiver import Archiver, get_discovery_conn
+from pggraph.db.base import get_db_conn, get_replica_conn
+from pggraph.db.fk_indexes import get_missing_fk_indexes
+from pggraph.db.maintenance import MaintenanceScheduler
+from pggraph.db.parallel import archive_parallel
+from pggraph.db.plan_compiler import compile_archive_function, get_archive_function_name
+from pggraph.db.restorer import Restorer
 from pggraph.utils.action_enum import ActionEnum
+from pggraph.utils.classes.row_reference import RowReference
 from pggraph.utils.funcs import chunks
+from pggraph.utils.reachability import ReachabilityIndex, DIRECTION_IN
 
 
 class PgGraphApi:
     config: Config
     references: Dict[str, dict]
     primary_keys: Dict[str, str]
+    catalog_state: dict
+    reachability: ReachabilityIndex
 
     def __init__(self, config_path: str = None, config: Config = None):
         if config_path:
@@ -33,41 +45,394 @@ class PgGraphApi:
         result = br.build_references(config=self.config)
         self.references = result['references']
         self.primary_keys = result['primary_keys']
+        self.catalog_state = result['catalog_state']
+        self.reachability = ReachabilityIndex(self.references)
+
+    def refresh(self, in_place: bool = True) -> List[str]:
+        """
+        Reload tables changed in DB catalog since the graph was built (or refreshed last time)
+        and patch references and primary keys in place.
+        With %in_place% = False a copy of the graph is patched and replaces the current one, so archiving,
+        which is already running with the current graph (e.g. jobs of the server), isn't affected.
+        Returns changed tables names (empty list, if nothing changed)
+        """
+        references, primary_keys = self.references, self.primary_keys
+        if not in_place:
+            references = br.copy_references(references)
+            primary_keys = dict(primary_keys)
+
+        result = br.refresh_references(self.config, references, primary_keys, self.catalog_state)
+        self.catalog_state = result['catalog_state']
+        if result['changed_tables']:
+            self.references, self.primary_keys = references, primary_keys
+            self.reachability = ReachabilityIndex(self.references)
+
+        return result['changed_tables']
 
     def run_action(self, args: Namespace):
         if args.action == ActionEnum.archive_table:
-            return self.archive_table(args.table, ids=args.ids)
+            return self.archive_table(args.table, ids=args.ids, where=args.where)
         elif args.action == ActionEnum.get_rows_references:
             return self.get_rows_references(args.table, ids=args.ids)
         elif args.action == ActionEnum.get_table_references:
             return self.get_table_references(args.table)
+        elif args.action == ActionEnum.get_missing_fk_indexes:
+            return self.get_missing_fk_indexes(args.table)
+        elif args.action == ActionEnum.compile_archive_plan:
+            return self.compile_archive_plan(args.table)
+        elif args.action == ActionEnum.archive_table_by_plan:
+            return self.archive_table_by_plan(args.table, ids=args.ids)
+        elif args.action == ActionEnum.restore_table:
+            return self.restore_table(args.table, ids=args.ids)
+        elif args.action == ActionEnum.get_reachable_tables:
+            return self.get_reachable_tables(args.table, direction=args.direction, max_depth=args.max_depth)
+        elif args.action == ActionEnum.get_cycles:
+            return self.get_cycles()
+        elif args.action == ActionEnum.get_graph_profile:
+            return self.get_graph_profile()
         else:
             raise NotImplementedError(f'Unknown action {args.action}')
 
-    def archive_table(self, table_name, ids: List[int]):
+    def archive_table(self, table_name, ids: List[int] = None, on_chunk: Callable[[Dict[str, int]], None] = None,
+                      where: str = None):
         """
         Recursive iterative archiving / deleting rows by %ids% from %table_name% table and related tables.
+        Instead of %ids% rows can be selected by SQL predicate on %table_name%
+        (%where%, e.g. "created_at < '2020-01-01'", see iter_root_chunks)
         pk_column - %table_name% primary key
+        %on_chunk% is called with total deleted rows after each archived chunk (progress)
+
+        Result:
+        {
+            'deleted_rows': {'table_a': 3, 'table_b': 10},
+            'skipped_rows': {'table_b': 2},
+            'blocked_rows': {'table_a': [5]}  # rows locked by other transactions longer than lock_timeout
+        }
         """
+        if (ids is None) == (where is None):
+            raise ValueError('ids or where should be set')
+        if where is not None:
+            return self.archive_tables({}, on_chunk=on_chunk, where={table_name: where})
+
+        return self.archive_tables({table_name: ids}, on_chunk=on_chunk)
+
+    def archive_tables(self, tables_ids: Dict[str, List[int]], on_chunk: Callable[[Dict[str, int]], None] = None,
+                       where: Dict[str, str] = None):
+        """
+        Archiving / deleting rows from several root tables in one run ({table_name: ids})
+        and / or rows matching SQL predicates on root tables (%where% - {table_name: predicate}).
+        Rows, reachable from several parents, are processed only once in a root chunk,
+        %tables_ids% rows, reachable from another root, are processed only once in a run.
+        """
+        roots = [(table_name, ids, None) for table_name, ids in tables_ids.items()]
+        roots += [(table_name, None, predicate) for table_name, predicate in (where or {}).items()]
+        for table_name, _, _ in roots:
+            if not self.primary_keys.get(table_name):
+                raise KeyError(f'Primary key for table {table_name} not found')
+
+        if self.config.archiver_config.workers > 1:
+            return self.archive_tables_parallel(roots, on_chunk=on_chunk)
+
         conn = get_db_conn(self.config)
+        read_conn = get_discovery_conn(self.config)
+        archiver = Archiver(conn, self.references, self.config, read_conn=read_conn)
+        if len(roots) > 1:
+            # root rows, reached from another root, are skipped when their own root is processed
+            for table_name, ids, _ in roots:
+                archiver.root_keys[table_name].update((id_, ) for id_ in ids or [])
+        scheduler = MaintenanceScheduler(self.config) if self.config.maintenance_config.enabled else None
 
         try:
-            logging.info(f'{table_name} - START')
+            for table_name, ids, predicate in roots:
+                logging.info(f'{table_name} - START')
 
-            pk_column = self.primary_keys.get(table_name)
-            if not pk_column:
-                raise KeyError(f'Primary key for table {table_name} not found')
+                if self.config.archiver_config.check_fk_indexes:
+                    self.check_fk_indexes(conn, table_name)
 
-            archiver = Archiver(conn, self.references, self.config)
-            rows = [{pk_column: id_} for id_ in ids]
+                pk_column = self.primary_keys[table_name]
+                for rows_chunk in self.iter_root_chunks(table_name, ids=ids, where=predicate):
+                    archiver.archive_root(table_name, rows_chunk, pk_column)
+                    if scheduler:
+                        scheduler.on_batch(archiver.deleted_rows)
+                    if on_chunk:
+                        on_chunk(dict(archiver.deleted_rows))
 
+                logging.info(f'{table_name} - END')
+
+            archiver.retry_deferred()
+            archiver.commit_pending()
+            if archiver.profiler:
+                archiver.profiler.log_report()
+        except Exception:
+            archiver.rollback_pending()
+            raise
+        finally:
+            conn.close()
+            if read_conn:
+                read_conn.close()
+            if scheduler:
+                scheduler.track(archiver.deleted_rows)
+                maintained_tables = scheduler.finish()
+
+        stats = archiver.get_stats()
+        if scheduler:
+            stats['maintained_tables'] = maintained_tables
+
+        return stats
+
+    def restore_table(self, table_name: str, ids: List[int]):
+        """
+        Restoring archived rows with %ids% of %table_name% and all archived rows referring to them
+        (reverse of archive_table, tables are restored in topological order, referenced rows before referring ones)
+
+        Result: {'restored_rows': {'table_a': 2, 'table_b': 10}, 'failed_tables': {'table_c': 1}}
+        failed_tables - number of moves, failed with integrity error (rows stay in archive table)
+        """
+        if not self.primary_keys.get(table_name):
+            raise KeyError(f'Primary key for table {table_name} not found')
+
+        conn = get_db_conn(self.config)
+        try:
+            restorer = Restorer(conn, self.references, self.config)
+
+            logging.info(f'{table_name} - START RESTORE')
+            rows = [(id_, ) for id_ in ids]
             for rows_chunk in chunks(rows, self.config.archiver_config.chunk_size):
-                archiver.archive_recursive(table_name, rows_chunk, pk_column)
+                restorer.restore_root(table_name, rows_chunk, self.primary_keys[table_name])
+            logging.info(f'{table_name} - END RESTORE')
+        finally:
+            conn.close()
+
+        return restorer.get_stats()
+
+    def compile_archive_plan(self, table_name: str) -> str:
+        """
+        Get SQL of PL/pgSQL function %schema%.pggraph_archive_<table_name>(ids), which archives rows
+        with all referring rows on the server in one call (see plan_compiler.compile_archive_function)
+        """
+        if table_name not in self.references:
+            raise KeyError(f'Table {table_name} not found')
+
+        conn = get_db_conn(self.config)
+        try:
+            return compile_archive_function(conn, self.config, self.references, self.primary_keys, table_name)
+        finally:
+            conn.close()
+
+    def install_archive_plan(self, table_name: str) -> str:
+        """Create (or replace) archive function for %table_name%, returns function name"""
+        query = self.compile_archive_plan(table_name)
+
+        conn = get_db_conn(self.config)
+        try:
+            with conn, conn.cursor() as curs:
+                curs.execute(query)
+        finally:
+            conn.close()
+
+        return f"{self.config.db_config.schema}.{get_archive_function_name(table_name)}"
+
+    def archive_table_by_plan(self, table_name: str, ids: List[int]):
+        """
+        Archiving / deleting rows by compiled archive function: one call and one transaction per chunk.
+        Function is recompiled before each run, so it always matches current graph.
+        In debug mode the function is only compiled and logged, nothing is installed or deleted
+        """
+        if self.config.archiver_config.is_debug:
+            logging.info(f'{table_name} - debug mode, archive function is not installed:\n'
+                         f'{self.compile_archive_plan(table_name)}')
+            return {'deleted_rows': {}}
+
+        function_name = self.install_archive_plan(table_name)
+
+        deleted_rows = defaultdict(int)
+        conn = get_db_conn(self.config)
+        try:
+            if self.config.archiver_config.to_archive:
+                Archiver(conn, self.references, self.config).provision_archive_tables(table_name)
+
+            for ids_chunk in chunks(ids, self.config.archiver_config.chunk_size):
+                logging.info(f'{table_name} - {function_name} {len(ids_chunk)} rows')
+                with conn, conn.cursor() as curs:
+                    curs.execute(SQL(f"SELECT {function_name}(%s)"), (ids_chunk, ))
+                    for ref_table, rows_count in curs.fetchone()[0].items():
+                        deleted_rows[ref_table] += rows_count
+        finally:
+            conn.close()
+
+        return {'deleted_rows': dict(deleted_rows)}
+
+    def archive_tables_parallel(self, roots: List[Tuple[str, Optional[List[int]], Optional[str]]],
+                                on_chunk: Callable[[Dict[str, int]], None] = None):
+        """
+        Archiving rows of %roots% ([(table_name, ids, where)], see archive_tables) by chunks in %workers% processes
+        (see parallel.archive_parallel), rows of each table are locked in the same order by advisory locks
+        to avoid deadlocks between workers
+        """
+        conn = get_db_conn(self.config)
+        try:
+            archiver = Archiver(conn, self.references, self.config)
+            for table_name, _, _ in roots:
+                if self.config.archiver_config.check_fk_indexes:
+                    self.check_fk_indexes(conn, table_name)
 
-            logging.info(f'{table_name} - END')
+                # archive tables are created before workers start, concurrent CREATE TABLE IF NOT EXISTS fails
+                if self.config.archiver_config.to_archive and not self.config.archiver_config.is_debug:
+                    archiver.provision_archive_tables(table_name)
         finally:
             conn.close()
 
+        roots_chunks = [
+            (table_name, self.iter_root_chunks(table_name, ids=ids, where=predicate))
+            for table_name, ids, predicate in roots
+        ]
+        scheduler = MaintenanceScheduler(self.config) if self.config.maintenance_config.enabled else None
+
+        def on_batch(deleted_rows: Dict[str, int]):
+            if scheduler:
+                scheduler.on_batch(deleted_rows)
+            if on_chunk:
+                on_chunk(dict(deleted_rows))
+
+        if not scheduler:
+            return archive_parallel(self.config, self.references, roots_chunks, self.primary_keys, on_batch=on_batch)
+
+        try:
+            stats = archive_parallel(self.config, self.references, roots_chunks, self.primary_keys, on_batch=on_batch)
+            scheduler.track(stats['deleted_rows'])
+        finally:
+            maintained_tables = scheduler.finish()
+
+        stats['maintained_tables'] = maintained_tables
+        return stats
+
+    def iter_root_chunks(self, table_name: str, ids: List[int] = None, where: str = None) -> Iterator[List[tuple]]:
+        """
+        Chunks of root table keys (tuples of primary key values): %ids% by chunk_size
+        or keys of rows matching %where% predicate, read by keyset pagination over the primary key
+        (WHERE pk > last ORDER BY pk LIMIT chunk_size), so only one chunk of keys is on the client at a time.
+        Rows, which stay after archiving a chunk (e.g. blocked), aren't read again
+        """
+        chunk_size = self.config.archiver_config.chunk_size
+        if where is None:
+            yield from chunks([(id_, ) for id_ in ids], chunk_size)
+            return
+
+        pk_columns = self.primary_keys[table_name]
+        table = f"{self.config.db_config.schema}.{table_name}"
+        first_query = SQL(f"SELECT {pk_columns} FROM {table} WHERE ({where}) ORDER BY {pk_columns} LIMIT %s")
+        next_query = SQL(
+            f"SELECT {pk_columns} FROM {table} WHERE ({pk_columns}) > %s AND ({where}) ORDER BY {pk_columns} LIMIT %s"
+        )
+
+        conn = get_db_conn(self.config)
+        conn.autocommit = True  # each page is read by its own statement, no long transaction while archiving
+        try:
+            last_row = None
+            while True:
+                with conn.cursor(cursor_factory=cursor) as curs:
+                    if last_row is None:
+                        curs.execute(first_query, (chunk_size, ))
+                    else:
+                        curs.execute(next_query, (last_row, chunk_size))
+                    rows_chunk = curs.fetchall()
+
+                if not rows_chunk:
+                    return
+
+                yield rows_chunk
+                last_row = rows_chunk[-1]
+        finally:
+            conn.close()
+
+    def check_fk_indexes(self, conn, table_name: str):
+        """
+        Pre-flight check before archiving: warn about Foreign Keys without index in %table_name% subtree,
+        every chunk archived by such Foreign Key means sequential scan of the referring table
+        """
+        subtree = {table_name, *self.reachability.get_reachable_tables(table_name, DIRECTION_IN)}
+        missing_indexes = get_missing_fk_indexes(conn, self.config.db_config, self.references, tables=subtree)
+        for index in missing_indexes:
+            logging.warning(
+                f"{table_name} - no index for {index['fk_name']} on {index['table']} ({index['columns']}), "
+                f"~{index['estimated_rows']} rows, {index['table_size']}: {index['create_index']}"
+            )
+
+        return missing_indexes
+
+    def get_missing_fk_indexes(self, table_name: str = None):
+        """
+        Get Foreign Keys without usable index in referring table (for %table_name% subtree or for all tables)
+
+        Result:
+        [
+            {
+                'table': 'table_b',
+                'columns': 'table_a_id',
+                'referenced_table': 'table_a',
+                'fk_name': 'table_b_table_a_id_fkey',
+                'estimated_rows': 1000000,
+                'table_size_bytes': 73728000,
+                'table_size': '70 MB',
+                'create_index': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS table_b_table_a_id_idx ON public.table_b (table_a_id);'
+            }
+        ]
+        """
+        tables = None
+        if table_name:
+            if table_name not in self.references:
+                raise KeyError(f'Table {table_name} not found')
+            tables = {table_name, *self.reachability.get_reachable_tables(table_name, DIRECTION_IN)}
+
+        conn = get_replica_conn(self.config)
+        try:
+            return get_missing_fk_indexes(conn, self.config.db_config, self.references, tables=tables)
+        finally:
+            conn.close()
+
+    def get_reachable_tables(self, table_name: str, direction: str = DIRECTION_IN, max_depth: int = None):
+        """
+        Get tables reachable from %table_name% with minimal depth (from reachability index, cached per table):
+         - direction 'in' - tables referring to the table directly or transitively (affected by its archiving)
+         - direction 'out' - tables referenced by the table directly or transitively
+
+        Result (table_name = table_a, direction = 'in'): {'table_b': 1, 'table_c': 1, 'table_d': 2}
+        """
+        if table_name not in self.references:
+            raise KeyError(f'Table {table_name} not found')
+
+        reachable = self.reachability.get_reachable_tables(table_name, direction=direction, max_depth=max_depth)
+        return dict(sorted(reachable.items(), key=lambda item: (item[1], item[0])))
+
+    def get_cycles(self) -> List[List[str]]:
+        """
+        Get strongly connected components of the graph with cycles (tables referring to each other transitively
+        or self-referencing tables)
+
+        Result: [['employee'], ['table_a', 'table_b']]
+        """
+        return self.reachability.get_cycles()
+
+    def get_graph_profile(self) -> dict:
+        """
+        Build the graph again in profile mode (see build_references): duration of catalog queries and
+        graph construction, peak memory, size of the graph and tables with the largest nested subtrees
+        (the graph of the api isn't replaced)
+
+        Result:
+        {
+            'timings_ms': {'get_catalog_state': 5.1, 'get_all_tables': 2.3, 'get_all_fk': 40.2, 'get_all_pk': 3.5,
+                           'build_graph': 120.7},
+            'memory_peak_kb': 2048.5,
+            'tables': 3,
+            'foreign_keys': 4,
+            'edges': 3,
+            'nested_nodes': 5,
+            'top_tables': [{'table': 'table_a', 'referring_tables': 2, 'nested_nodes': 3}, ...]
+        }
+        """
+        return br.build_references(config=self.config, profile=True)['profile']
+
     def get_table_references(self, table_name: str):
         """
         Get table references:
@@ -129,7 +494,7 @@ class PgGraphApi:
 
         rows_refs = {id_: {} for id_ in ids}
         s_in = ', '.join('%s' for _ in ids)
-        conn = get_db_conn(self.config)
+        conn = get_replica_conn(self.config)
         try:
             for ref_table_name, ref_table_data in self.references[table_name].items():
                 for ref_tables in rows_refs.values():
@@ -153,3 +518,55 @@ class PgGraphApi:
             conn.close()
 
         return rows_refs
+
+    def iter_rows_references(self, table_name: str, ids: List[int]) -> Iterator[RowReference]:
+        """
+        Bulk version of get_rows_references for large %ids% sets: ids are loaded by COPY into temp table,
+        each referring Foreign Key is joined with it and rows are streamed by server-side cursor.
+        References are yielded as flat records, grouped by referring table and Foreign Key (not by id)
+
+        Result (table_name = table_a, ids = [1, 5, 6]):
+            RowReference(id=1, table='table_b', fk='table_a_id', row_key={'id': 1}),
+            RowReference(id=1, table='table_b', fk='table_a_id', row_key={'id': 4}),
+            RowReference(id=5, table='table_c', fk='a_id', row_key={'id': 12}),
+            ...
+        """
+        if table_name not in self.references:
+            raise KeyError(f'Table {table_name} not found')
+
+        pk_column = self.primary_keys.get(table_name)
+        if not pk_column:
+            raise KeyError(f'Primary key for table {table_name} not found')
+        if ',' in pk_column:
+            raise ValueError(f'Table {table_name} has composite primary key ({pk_column})')
+
+        schema = self.config.db_config.schema
+        conn = get_db_conn(self.config)
+        try:
+            with conn.cursor() as curs:
+                curs.execute(SQL(
+                    f"CREATE TEMP TABLE _pggraph_ids ON COMMIT DROP AS "
+                    f"SELECT {pk_column} AS id FROM {schema}.{table_name} WITH NO DATA"
+                ))
+                ids_data = '\n'.join(str(id_) for id_ in dict.fromkeys(ids))
+                curs.copy_expert('COPY _pggraph_ids (id) FROM STDIN', io.StringIO(ids_data))
+                curs.execute('ALTER TABLE _pggraph_ids ADD PRIMARY KEY (id); ANALYZE _pggraph_ids;')
+
+            for ref_table_name, ref_table_data in self.references[table_name].items():
+                for fk in ref_table_data['references']:
+                    key_columns = [col.strip() for col in (fk.pk_ref or fk.fk_ref).split(',')]
+                    query = SQL(
+                        f"SELECT t.{fk.fk_ref}, {', '.join(f't.{col}' for col in key_columns)} "
+                        f"FROM {schema}.{ref_table_name} t "
+                        f"INNER JOIN _pggraph_ids i ON i.id = t.{fk.fk_ref}"
+                    )
+                    with conn.cursor(name=f'pggraph_{fk.fk_name}'[:63], cursor_factory=cursor) as curs:
+                        curs.itersize = self.config.archiver_config.chunk_size
+                        curs.execute(query)
+                        for row in curs:
+                            yield RowReference(
+                                id=row[0], table=ref_table_name, fk=fk.fk_ref,
+                                row_key=dict(zip(key_columns, row[1:])),
+                            )
+        finally:
+            conn.close()
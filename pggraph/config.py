@@ -12,6 +12,10 @@ from pggraph.utils.funcs import arg_to_bool
 class Config:
     db_config: "DBConfig"
     archiver_config: "ArchiverConfig"
+    server_config: "ServerConfig"
+    profiler_config: "ProfilerConfig"
+    maintenance_config: "MaintenanceConfig"
+    replica_config: "ReplicaConfig"
 
     def __init__(self, config_path: str = None, config_data: dict = None):
         if config_data:
@@ -26,6 +30,10 @@ class Config:
         config.read(config_path)
         self.db_config = DBConfig.from_config(config, 'db')
         self.archiver_config = ArchiverConfig.from_config(config, 'archive')
+        self.server_config = ServerConfig.from_config(config, 'server')
+        self.profiler_config = ProfilerConfig.from_config(config, 'profiler')
+        self.maintenance_config = MaintenanceConfig.from_config(config, 'maintenance')
+        self.replica_config = ReplicaConfig.from_config(config, 'replica')
 
     def from_dict(self, config_data: dict):
         if not isinstance(config_data, dict):
@@ -37,6 +45,10 @@ class Config:
             raise KeyError('config_data should contain db settings')
 
         self.archiver_config = ArchiverConfig.from_dict(config_data.get('archive', {}))
+        self.server_config = ServerConfig.from_dict(config_data.get('server', {}))
+        self.profiler_config = ProfilerConfig.from_dict(config_data.get('profiler', {}))
+        self.maintenance_config = MaintenanceConfig.from_dict(config_data.get('maintenance', {}))
+        self.replica_config = ReplicaConfig.from_dict(config_data.get('replica', {}))
 
 
 @dataclass
@@ -56,6 +68,18 @@ class ArchiverConfig(BaseConfig):
     max_depth: int = 20
     to_archive: bool = True
     archive_suffix: str = 'archive'
+    check_fk_indexes: bool = True
+    lock_timeout: int = 0
+    workers: int = 1
+    commit_mode: str = 'edge'
+    commit_every: int = 100
+    commit_interval_ms: int = 1000
+    partition_by_month: bool = False
+    archive_date_column: str = 'archived_at'
+
+    def __post_init__(self):
+        if self.commit_mode not in ('edge', 'count', 'chunk', 'time'):
+            raise ValueError(f'Unknown commit_mode {self.commit_mode} (should be edge, count, chunk or time)')
 
     @classmethod
     def from_config(cls, config: ConfigParser, section: str):
@@ -64,4 +88,86 @@ class ArchiverConfig(BaseConfig):
         conf.chunk_size = int(conf.chunk_size)
         conf.max_depth = int(conf.max_depth)
         conf.to_archive = arg_to_bool(str(conf.to_archive), default_value=cls.to_archive)
+        conf.check_fk_indexes = arg_to_bool(str(conf.check_fk_indexes), default_value=cls.check_fk_indexes)
+        conf.lock_timeout = int(conf.lock_timeout)
+        conf.workers = int(conf.workers)
+        conf.commit_every = int(conf.commit_every)
+        conf.commit_interval_ms = int(conf.commit_interval_ms)
+        conf.partition_by_month = arg_to_bool(str(conf.partition_by_month), default_value=cls.partition_by_month)
+        return conf
+
+
+@dataclass
+class ServerConfig(BaseConfig):
+    host: str = '127.0.0.1'
+    port: int = 8080
+    workers: int = 2
+    max_queued_jobs: int = 100
+    jobs_history: int = 1000
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str):
+        conf = super().from_config(config, section)
+        conf.port = int(conf.port)
+        conf.workers = int(conf.workers)
+        conf.max_queued_jobs = int(conf.max_queued_jobs)
+        conf.jobs_history = int(conf.jobs_history)
+        return conf
+
+
+@dataclass
+class ProfilerConfig(BaseConfig):
+    enabled: bool = False
+    slow_query_ms: int = 1000
+    explain_sample: int = 5
+    top: int = 10
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str):
+        conf = super().from_config(config, section)
+        conf.enabled = arg_to_bool(str(conf.enabled), default_value=cls.enabled)
+        conf.slow_query_ms = int(conf.slow_query_ms)
+        conf.explain_sample = int(conf.explain_sample)
+        conf.top = int(conf.top)
+        return conf
+
+
+@dataclass
+class MaintenanceConfig(BaseConfig):
+    enabled: bool = False
+    mode: str = 'end'
+    threshold_rows: int = 10000
+    workers: int = 1
+    vacuum: bool = True
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str):
+        conf = super().from_config(config, section)
+        conf.enabled = arg_to_bool(str(conf.enabled), default_value=cls.enabled)
+        if conf.mode not in ('batches', 'end'):
+            raise ValueError(f'Unknown maintenance mode {conf.mode} (should be batches or end)')
+        conf.threshold_rows = int(conf.threshold_rows)
+        conf.workers = int(conf.workers)
+        conf.vacuum = arg_to_bool(str(conf.vacuum), default_value=cls.vacuum)
+        return conf
+
+
+@dataclass
+class ReplicaConfig(BaseConfig):
+    enabled: bool = False
+    host: str = ''  # empty connection settings are taken from [db]
+    port: int = 0
+    user: str = ''
+    password: str = ''
+    dbname: str = ''
+    max_lag_ms: int = 0
+    archive_discovery: bool = False
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, section: str):
+        conf = super().from_config(config, section)
+        conf.enabled = arg_to_bool(str(conf.enabled), default_value=cls.enabled)
+        conf.port = int(conf.port)
+        conf.max_lag_ms = int(conf.max_lag_ms)
+        conf.archive_discovery = arg_to_bool(str(conf.archive_discovery), default_value=cls.archive_discovery)
         return conf
@@ -2,18 +2,39 @@
 Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
 Please, see the LICENSE.md file in project's root for full licensing information.
 """
+import hashlib
 import logging
-from typing import List
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, timedelta
+from typing import List, Dict, Set, Optional, Tuple
 
 from psycopg2._json import Json
-from psycopg2._psycopg import connection
-from psycopg2.extras import execute_values, DictCursor
+from psycopg2._psycopg import connection, cursor
+from psycopg2.errors import LockNotAvailable, DeadlockDetected
+from psycopg2.extras import execute_values
 from psycopg2.sql import SQL
 
 from pggraph.config import Config
+from pggraph.db.base import get_table_columns, get_replica_conn
+from pggraph.db.profiler import QueryProfiler
 from pggraph.utils.classes.foreign_key import ForeignKey
+from pggraph.utils.reachability import get_subtree_tables
 
 TAB_SYMBOL = '\t'
+ADVISORY_LOCK_BUCKETS = 256  # max advisory locks per table in one transaction
+# advisory lock, serializing provision_archive_tables
+PROVISION_LOCK_KEY = int.from_bytes(hashlib.md5(b'pggraph:provision').digest()[:8], 'big', signed=True)
+EDGE_SAVEPOINT = 'pggraph_edge'
+
+COMMIT_EDGE = 'edge'    # own transaction for each edge
+COMMIT_COUNT = 'count'  # commit every commit_every edges
+COMMIT_CHUNK = 'chunk'  # commit after each root chunk
+COMMIT_TIME = 'time'    # commit every commit_interval_ms
+
+SERVER_DELETE_RULES = ('CASCADE', 'SET NULL')  # ON DELETE actions, which can be left to the server in delete-only mode
+JSON_TYPES = ('json', 'jsonb')
 
 
 class Archiver:
@@ -21,17 +42,134 @@ class Archiver:
     config: Config
     current_depth: int
     references: dict
-
-    def __init__(self, conn: connection, references: dict, config: Config):
+    visited: Dict[str, Set[tuple]]
+    root_keys: Dict[str, Set[tuple]]
+    deleted_rows: Dict[str, int]
+    skipped_rows: Dict[str, int]
+    deferred: List[tuple]
+    blocked_rows: Dict[str, list]
+    table_columns: Dict[str, dict]
+    profiler: Optional[QueryProfiler]
+    advisory_locks: bool
+    pending_edges: int
+    last_commit_at: float
+    archive_tables: Set[str]
+    cascade_tables: Set[str]
+
+    def __init__(self, conn: connection, references: dict, config: Config, advisory_locks: bool = False,
+                 read_conn: connection = None):
         self.conn = conn
+        # connection for discovery of referring rows keys (e.g. replica, see get_discovery_conn),
+        # locking and deleting statements always go through %conn%
+        self.read_conn = read_conn or conn
         self.config = config
         self.current_depth = 0
         self.references = references
+        self.visited = defaultdict(set)  # primary keys of rows, already processed in current root chunk
+        # keys of rows, which are roots of the run, kept in visited between root chunks (see clear_visited)
+        self.root_keys = defaultdict(set)
+        self.deleted_rows = defaultdict(int)
+        self.skipped_rows = defaultdict(int)
+        self.deferred = []  # root chunks, not archived because of locked rows: (table_name, rows, pk_cols)
+        self.blocked_rows = defaultdict(list)
+        self.visited_journal = None
+        self.table_columns = {}  # columns of archived tables from catalog, see get_table_columns
+        self.profiler = QueryProfiler(config.profiler_config) if config.profiler_config.enabled else None
+        # several Archivers in parallel: lock rows of each table in the same order (see lock_rows)
+        self.advisory_locks = advisory_locks
+        self.pending_edges = 0  # edges archived in current grouped transaction, see transaction
+        self.last_commit_at = time.monotonic()
+        self.archive_tables = set()  # tables with provisioned archive tables, see provision_archive_tables
+        # delete-only mode: tables, whose rows are deleted by the server through ON DELETE CASCADE
+        self.cascade_tables = set() if config.archiver_config.to_archive else get_cascade_tables(references)
+
+    def get_stats(self) -> dict:
+        stats = {
+            'deleted_rows': dict(self.deleted_rows),
+            'skipped_rows': dict(self.skipped_rows),
+            'blocked_rows': dict(self.blocked_rows),
+        }
+        if self.profiler:
+            stats['profile'] = self.profiler.get_report()
+
+        return stats
+
+    def reset_stats(self):
+        self.deleted_rows = defaultdict(int)
+        self.skipped_rows = defaultdict(int)
+        self.blocked_rows = defaultdict(list)
+
+    def execute(self, curs, query: SQL, params, table_name: str, statement: str, columns: str = ''):
+        """Execute archiver statement (through profiler if it is enabled)"""
+        if self.profiler:
+            self.profiler.execute(curs, query, params, table_name, statement, columns)
+        else:
+            curs.execute(query, params)
+
+    def archive_root(self, table_name: str, rows: List[tuple], pk_cols: str = 'id') -> bool:
+        """
+        Archive chunk of root table rows (tuples of %pk_cols% values).
+        If lock_timeout is set and some row in the subtree is locked by another transaction longer than lock_timeout
+        (or deadlock is detected), current edge is rolled back and the chunk is deferred to retry_deferred
+        (already archived edges stay archived)
 
-    def archive_recursive(self, table_name: str, rows: List[dict], pk_cols: str = 'id'):
+        :return: True if chunk is archived, False if it is deferred
+        """
+        if self.config.archiver_config.to_archive and not self.config.archiver_config.is_debug:
+            self.provision_archive_tables(table_name)
+
+        self.visited_journal = []
+        try:
+            self.archive_recursive(table_name, rows, pk_cols)
+            if self.config.archiver_config.commit_mode == COMMIT_CHUNK:
+                self.commit_pending()
+            return True
+        except (LockNotAvailable, DeadlockDetected) as error:
+            if isinstance(error, LockNotAvailable) and not self.config.archiver_config.lock_timeout:
+                raise
+
+            logging.warning(f'{table_name} - {len(rows)} rows deferred: {str(error).strip()}')
+            self.current_depth = 0
+            for visited_table, row_key in self.visited_journal:
+                self.visited[visited_table].discard(row_key)
+
+            self.deferred.append((table_name, rows, pk_cols))
+            if self.config.archiver_config.commit_mode == COMMIT_CHUNK:
+                self.commit_pending()
+            return False
+        finally:
+            self.visited_journal = None
+            self.clear_visited()
+
+    def clear_visited(self):
+        """
+        Forget rows processed in the root chunk, so memory doesn't grow with the run.
+        Keys of root rows from root_keys are kept: they are skipped when their root is reached
+        """
+        visited, self.visited = self.visited, defaultdict(set)
+        for table_name, root_keys in self.root_keys.items():
+            if visited.get(table_name):
+                self.visited[table_name] = visited[table_name] & root_keys
+
+    def retry_deferred(self):
+        """
+        Retry deferred root chunks row by row, rows still locked after that are reported in blocked_rows
+        """
+        deferred, self.deferred = self.deferred, []
+        for table_name, rows, pk_cols in deferred:
+            logging.info(f'{table_name} - retry {len(rows)} deferred rows')
+            for row in rows:
+                if not self.archive_root(table_name, [row], pk_cols):
+                    self.blocked_rows[table_name].append(row[0] if len(row) == 1 else list(row))
+
+        # rows, deferred again while retrying, are already reported as blocked
+        self.deferred = []
+
+    def archive_recursive(self, table_name: str, rows: List[tuple], pk_cols: str = 'id'):
         """
         Recursive archiving/clearing table
         Algorithm:
+            - Skip rows, already processed in this root chunk (shared subtrees) or as rows of other roots
             - For each dependency of the table (ref_table)
                 - For each Foreign Key, referencing to the main table
                     If dependent table doesn't have its own dependencies
@@ -41,7 +179,7 @@ class Archiver:
             - After archiving all the dependencies, archive the main table
 
         :param table_name: name of the table to be archived
-        :param rows: list of archived row IDs
+        :param rows: list of archived row IDs (tuples of %pk_cols% values)
         :param pk_cols: Primary Key columns
         """
         tabs = TAB_SYMBOL*self.current_depth
@@ -52,6 +190,9 @@ class Archiver:
             logging.info(f'{tabs}{table_name} - MAX_DEPTH exceeded (depth={self.current_depth})')
             return
 
+        if not self.config.archiver_config.is_debug:
+            rows = self.filter_visited(table_name, rows, tabs=tabs)
+
         if not rows:
             logging.info(f'{tabs}{table_name} - EMPTY rows - return')
             return
@@ -60,38 +201,144 @@ class Archiver:
         self.current_depth += 1
 
         logging.info(f'{tabs}START ARCHIVE REFERRING TABLES')
+        self.archive_referring_tables(table_name, rows, pk_cols, tabs=tabs)
+        logging.info(f'{tabs}END ARCHIVE REFERRING TABLES')
+
+        self.current_depth -= 1
+        self.archive_by_ids(table_name=table_name, pk_columns=pk_cols, row_pks=rows)
 
+    def archive_referring_tables(self, table_name: str, rows: List[tuple], pk_cols: str, tabs: str,
+                                 with_self_refs: bool = True):
+        """
+        Archive rows of all tables, referring to %rows% of %table_name%.
+        Self-referencing Foreign Keys are archived with the whole sub-hierarchy by archive_hierarchy
+        """
         for ref_table, ref_data in self.references[table_name].items():
-            for ref_fk in ref_data['references']:
+            ref_fks = [fk for fk in ref_data['references'] if not self.is_handled_by_server(ref_table, fk, tabs)]
+
+            if ref_table == table_name and not self.config.archiver_config.is_debug:
+                if with_self_refs and ref_fks:
+                    self.archive_hierarchy(table_name, ref_fks, rows, pk_cols)
+                continue
+
+            for ref_fk in ref_fks:
                 logging.debug(f'{tabs}{ref_table} - {ref_fk}')
 
                 if self.config.archiver_config.is_debug:
                     self.archive_recursive(ref_table, rows, ref_fk.pk_ref)
                     continue
 
+                fk_rows = get_key_values(rows, pk_cols, ref_fk.pk_main)
                 if not self.references.get(ref_table):
-                    self.archive_by_fk(ref_table, ref_fk, fk_rows=rows)
+                    self.archive_by_fk(ref_table, ref_fk, fk_rows=fk_rows)
                     continue
 
-                with self.conn.cursor(cursor_factory=DictCursor) as cursor:
-                    self.select_rows_by_fk(cursor, table_name=ref_table, fk=ref_fk, rows=rows, tabs=tabs)
-                    ref_rows_chunk = cursor.fetchmany(size=self.config.archiver_config.chunk_size)
+                with self.read_conn.cursor(cursor_factory=cursor) as curs:
+                    self.select_rows_by_fk(curs, table_name=ref_table, fk=ref_fk, fk_rows=fk_rows, tabs=tabs)
+                    ref_rows_chunk = curs.fetchmany(size=self.config.archiver_config.chunk_size)
                     while ref_rows_chunk:
                         self.archive_recursive(ref_table, ref_rows_chunk, ref_fk.pk_ref)
-                        ref_rows_chunk = cursor.fetchmany(size=self.config.archiver_config.chunk_size)
+                        ref_rows_chunk = curs.fetchmany(size=self.config.archiver_config.chunk_size)
 
-        logging.info(f'{tabs}END ARCHIVE REFERRING TABLES')
+    def is_handled_by_server(self, table_name: str, fk: ForeignKey, tabs: str) -> bool:
+        """
+        In delete-only mode rows of %table_name%, referring by %fk% with ON DELETE SET NULL, or with ON DELETE CASCADE
+        if all tables referring to %table_name% (transitively) are handled by the server too, aren't traversed:
+        the server updates / deletes them itself, when referenced rows are deleted
+        """
+        if self.config.archiver_config.to_archive or not is_handled_by_server(table_name, fk, self.cascade_tables):
+            return False
 
-        self.current_depth -= 1
-        self.archive_by_ids(table_name=table_name, pk_columns=pk_cols, row_pks=rows)
+        logging.debug(f'{tabs}{table_name} - ON DELETE {fk.delete_rule} by server - {fk}')
+        return True
+
+    def archive_hierarchy(self, table_name: str, fks: List[ForeignKey], rows: List[tuple], pk_cols: str):
+        """
+        Archiving all descendants of %rows% in self-referencing table (comments tree, org chart etc.)
+        Algorithm:
+            - Collect keys of all descendants by recursive CTE on the server
+            - Archive tables referring to descendants (except the table itself)
+            - Archive all descendants by one statement (the same recursive CTE)
+        Depth of the hierarchy isn't limited by max_depth
+
+        :param table_name: name of the self-referencing table
+        :param fks: self-referencing Foreign Keys
+        :param rows: parent rows, whose descendants should be archived (tuples of %pk_cols% values)
+        :param pk_cols: Primary Key columns
+        """
+        tabs = TAB_SYMBOL*self.current_depth
+        logging.info(f'{tabs}{table_name} - archive_hierarchy of {len(rows)} rows by {[fk.fk_name for fk in fks]}')
+
+        table = f"{self.config.db_config.schema}.{table_name}"
+        hierarchy_query, row_ids = get_hierarchy_query(table, fks, rows, pk_cols)
+
+        has_other_refs = any(ref_table != table_name for ref_table in self.references[table_name])
+        if has_other_refs:
+            with self.read_conn.cursor(cursor_factory=cursor) as curs:
+                query = SQL(f"{hierarchy_query} SELECT DISTINCT {pk_cols} FROM hierarchy")
+                logging.debug(f"{tabs}{query}"[:1000])
+                self.execute(curs, query, row_ids, table_name, 'select_hierarchy', pk_cols)
+
+                descendants_chunk = curs.fetchmany(size=self.config.archiver_config.chunk_size)
+                while descendants_chunk:
+                    descendants_chunk = self.filter_visited(table_name, descendants_chunk, tabs=tabs)
+                    if descendants_chunk:
+                        self.current_depth += 1
+                        self.archive_referring_tables(
+                            table_name, descendants_chunk, pk_cols, tabs=tabs + TAB_SYMBOL, with_self_refs=False
+                        )
+                        self.current_depth -= 1
+                    descendants_chunk = curs.fetchmany(size=self.config.archiver_config.chunk_size)
+
+        if self.config.archiver_config.is_debug:
+            return
+
+        with self.transaction():
+            self.set_lock_timeout()
+            if self.config.archiver_config.to_archive:
+                archive_table_name = self.create_archive_table(table_name, tabs=tabs)
+
+            with self.conn.cursor(cursor_factory=cursor) as curs:
+                query = SQL(
+                    f"{hierarchy_query} DELETE FROM {self.config.db_config.schema}.{table_name} "
+                    f"WHERE ({pk_cols}) IN (SELECT {pk_cols} FROM hierarchy) RETURNING *"
+                )
+                logging.debug(f"{tabs}DELETE FROM {table_name} hierarchy of {len(rows)} rows")
+                self.execute(curs, query, row_ids, table_name, 'delete_hierarchy', pk_cols)
+                self.deleted_rows[table_name] += curs.rowcount
+
+                if self.config.archiver_config.to_archive:
+                    self.insert_returned_rows(curs, table_name, archive_table_name, tabs=tabs)
+
+    def filter_visited(self, table_name: str, rows: List[tuple], tabs: str) -> List[tuple]:
+        """
+        Filter out rows, which were already processed in this root chunk (e.g. reached from another parent table)
+        or with another root (see root_keys), and mark the rest as processed
+        """
+        visited = self.visited[table_name]
+
+        new_rows = []
+        for row in rows:
+            if row not in visited:
+                visited.add(row)
+                new_rows.append(row)
+                if self.visited_journal is not None:
+                    self.visited_journal.append((table_name, row))
 
-    def archive_by_fk(self, table_name: str, fk: ForeignKey, fk_rows: List[dict]):
+        skipped_count = len(rows) - len(new_rows)
+        if skipped_count:
+            self.skipped_rows[table_name] += skipped_count
+            logging.info(f'{tabs}{table_name} - skip {skipped_count} already processed rows')
+
+        return new_rows
+
+    def archive_by_fk(self, table_name: str, fk: ForeignKey, fk_rows: List[tuple]):
         """
         Archiving a table with the specified foreign keys
 
         :param table_name: name of the table to be archived
         :param fk: ForeignKey object
-        :param fk_rows: foreign key values to be archived
+        :param fk_rows: foreign key values to be archived (tuples of %fk.pk_main% values)
         """
         tabs = TAB_SYMBOL*self.current_depth
         logging.info(f'{tabs}{table_name} - archive_by_fk {len(fk_rows)} rows by {fk}')
@@ -100,30 +347,32 @@ class Archiver:
             return
 
         total_archived_rows = 0
-        with self.conn:  # транзакция
+        with self.transaction():
+            self.set_lock_timeout()
             if self.config.archiver_config.to_archive:
                 archive_table_name = self.create_archive_table(table_name, tabs=tabs)
 
-            with self.conn.cursor(cursor_factory=DictCursor) as cursor:
-                self.select_rows_by_fk(cursor, table_name, fk=fk, rows=fk_rows, tabs=tabs, for_update=True)
-                self.delete_rows_by_fk(cursor, table_name, fk=fk, fk_rows=fk_rows, tabs=tabs)
+            with self.conn.cursor(cursor_factory=cursor) as curs:
+                if self.advisory_locks and fk.pk_ref:
+                    self.select_rows_by_fk(curs, table_name, fk=fk, fk_rows=fk_rows, tabs=tabs)
+                    self.lock_rows(table_name, curs.fetchall())
+
+                self.select_rows_by_fk(curs, table_name, fk=fk, fk_rows=fk_rows, tabs=tabs, for_update=True)
+                self.delete_rows_by_fk(curs, table_name, fk=fk, fk_rows=fk_rows, tabs=tabs)
+                self.deleted_rows[table_name] += curs.rowcount
 
                 if self.config.archiver_config.to_archive:
-                    rows_chunk = cursor.fetchmany(size=self.config.archiver_config.chunk_size)
-                    while rows_chunk:
-                        total_archived_rows += len(rows_chunk)
-                        self.insert_rows(archive_table_name=archive_table_name, values=rows_chunk, tabs=tabs)
-                        rows_chunk = cursor.fetchmany(size=self.config.archiver_config.chunk_size)
+                    total_archived_rows = self.insert_returned_rows(curs, table_name, archive_table_name, tabs=tabs)
 
         return total_archived_rows
 
-    def archive_by_ids(self, table_name: str, pk_columns: str, row_pks: List[dict]):
+    def archive_by_ids(self, table_name: str, pk_columns: str, row_pks: List[tuple]):
         """
         Archiving a table with the specified primary keys
 
         :param table_name: name of the table to be archived
         :param pk_columns: primary key columns
-        :param row_pks: primary keys values to be archived
+        :param row_pks: primary keys values to be archived (tuples of %pk_columns% values)
         """
         tabs = TAB_SYMBOL*self.current_depth
         logging.info(f'{tabs}{table_name} - archive_by_ids {len(row_pks)} rows by {pk_columns}')
@@ -132,56 +381,236 @@ class Archiver:
             return
 
         total_archived_rows = 0
-        with self.conn:  # транзакция
+        with self.transaction():
+            self.set_lock_timeout()
             if self.config.archiver_config.to_archive:
                 archive_table_name = self.create_archive_table(table_name, tabs=tabs)
 
-            with self.conn.cursor(cursor_factory=DictCursor) as cursor:
-                self.select_rows_for_update(cursor, table_name, pk_columns=pk_columns, rows=row_pks, tabs=tabs)
-                self.delete_rows_by_ids(cursor, table_name, pk_columns=pk_columns, rows=row_pks, tabs=tabs)
+            with self.conn.cursor(cursor_factory=cursor) as curs:
+                if self.advisory_locks:
+                    self.lock_rows(table_name, row_pks)
+
+                self.select_rows_for_update(curs, table_name, pk_columns=pk_columns, rows=row_pks, tabs=tabs)
+                self.delete_rows_by_ids(curs, table_name, pk_columns=pk_columns, rows=row_pks, tabs=tabs)
+                self.deleted_rows[table_name] += curs.rowcount
 
                 if self.config.archiver_config.to_archive:
-                    rows_chunk = cursor.fetchmany(size=self.config.archiver_config.chunk_size)
-                    while rows_chunk:
-                        total_archived_rows += len(rows_chunk)
-                        self.insert_rows(archive_table_name=archive_table_name, values=rows_chunk, tabs=tabs)
-                        rows_chunk = cursor.fetchmany(size=self.config.archiver_config.chunk_size)
+                    total_archived_rows = self.insert_returned_rows(curs, table_name, archive_table_name, tabs=tabs)
 
         return total_archived_rows
 
+    @contextmanager
+    def transaction(self):
+        """
+        Transaction of one edge (commit_mode = edge) or savepoint in grouped transaction, which is committed
+        every commit_every edges (count), after each root chunk (chunk) or every commit_interval_ms (time).
+        If an edge fails, only this edge is rolled back, the rest of grouped transaction is committed later
+        (see commit_pending), or rolled back if the run fails (see rollback_pending)
+        """
+        archiver_config = self.config.archiver_config
+        if archiver_config.commit_mode == COMMIT_EDGE:
+            with self.conn:  # транзакция
+                yield
+            return
+
+        with self.conn.cursor() as curs:
+            curs.execute(f'SAVEPOINT {EDGE_SAVEPOINT}')
+        try:
+            yield
+        except Exception:
+            with self.conn.cursor() as curs:
+                curs.execute(f'ROLLBACK TO SAVEPOINT {EDGE_SAVEPOINT}')
+            raise
+
+        with self.conn.cursor() as curs:
+            curs.execute(f'RELEASE SAVEPOINT {EDGE_SAVEPOINT}')
+
+        self.pending_edges += 1
+        if archiver_config.commit_mode == COMMIT_COUNT and self.pending_edges >= archiver_config.commit_every:
+            self.commit_pending()
+        elif (archiver_config.commit_mode == COMMIT_TIME
+              and (time.monotonic() - self.last_commit_at) * 1000 >= archiver_config.commit_interval_ms):
+            self.commit_pending()
+
+    def commit_pending(self):
+        """Commit grouped transaction (should be called at the end of the run in grouped commit modes)"""
+        if not self.conn.closed:
+            self.conn.commit()
+
+        if self.pending_edges:
+            logging.debug(f'COMMIT {self.pending_edges} edges')
+        self.pending_edges = 0
+        self.last_commit_at = time.monotonic()
+
+    def rollback_pending(self):
+        """Roll back grouped transaction, when the run fails with unexpected error"""
+        if not self.conn.closed:
+            self.conn.rollback()
+
+        if self.pending_edges:
+            logging.warning(f'ROLLBACK {self.pending_edges} edges')
+        self.pending_edges = 0
+        self.last_commit_at = time.monotonic()
+
+    def set_lock_timeout(self):
+        """Don't wait for rows locked by other transactions longer than lock_timeout (ms) in current transaction"""
+        if self.config.archiver_config.lock_timeout:
+            with self.conn.cursor() as cursor:
+                cursor.execute('SET LOCAL lock_timeout = %s', (self.config.archiver_config.lock_timeout, ))
+
+    def lock_rows(self, table_name: str, rows: List[tuple]):
+        """
+        Take transaction advisory locks on buckets of %rows% primary keys in sorted order before locking the rows,
+        so parallel Archivers, sharing some rows, wait for each other instead of deadlocking
+        """
+        lock_keys = sorted({get_advisory_lock_key(table_name, row) for row in rows})
+        if not lock_keys:
+            return
+
+        with self.conn.cursor() as curs:
+            curs.execute('SELECT pg_advisory_xact_lock(k) FROM unnest(%s::bigint[]) k', (lock_keys, ))
+
     def create_archive_table(self, table_name: str, tabs: str) -> str:
-        new_table_name = f"{table_name}_{self.config.archiver_config.archive_suffix}"
-        query = SQL(
-            f"CREATE TABLE IF NOT EXISTS {self.config.db_config.schema}.{new_table_name} "
-            f"(LIKE {self.config.db_config.schema}.{table_name})"
-        )
+        """Archive table of %table_name%, it's created in current transaction unless it is already provisioned"""
+        new_table_name = self.get_archive_table_name(table_name)
+        if table_name in self.archive_tables:
+            return new_table_name
 
-        with self.conn.cursor(cursor_factory=DictCursor) as cur:
+        query = self.get_create_archive_table_query(table_name)
+        with self.conn.cursor() as cur:
             cur.execute(query)
 
         logging.debug(f"{tabs}{query}")
 
         return new_table_name
 
-    def insert_rows(self, archive_table_name: str, values: List[dict], tabs: str):
-        column_names = ', '.join(values[0].keys())
+    def provision_archive_tables(self, table_name: str):
+        """
+        Create missing archive tables of the whole %table_name% subtree in one transaction before archiving it
+        (with partitions of current and next month if partition_by_month is set).
+        Provisioned tables are cached for the run, so archiving edges doesn't run DDL
+        """
+        tables = sorted(get_subtree_tables(self.references, table_name) - self.archive_tables)
+        if not tables:
+            return
+
+        schema = self.config.db_config.schema
+        partition_by_month = self.config.archiver_config.partition_by_month
+        partitions = {
+            table: get_month_partitions(self.get_archive_table_name(table), date.today()) if partition_by_month else []
+            for table in tables
+        }
+        relation_names = [self.get_archive_table_name(table) for table in tables]
+        relation_names += [partition[0] for table in tables for partition in partitions[table]]
+
+        with self.conn:  # транзакция
+            with self.conn.cursor(cursor_factory=cursor) as curs:
+                # concurrent CREATE TABLE IF NOT EXISTS of the same table fails on pg_type unique index,
+                # so archives (server jobs, other processes) provision tables one by one
+                curs.execute('SELECT pg_advisory_xact_lock(%s)', (PROVISION_LOCK_KEY, ))
+                curs.execute(
+                    "SELECT c.relname, c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                    "WHERE n.nspname = %s AND c.relname = ANY(%s)",
+                    (schema, relation_names)
+                )
+                existing = dict(curs.fetchall())
+
+                for table in tables:
+                    archive_table_name = self.get_archive_table_name(table)
+                    if archive_table_name not in existing:
+                        query = self.get_create_archive_table_query(table)
+                        logging.debug(query)
+                        curs.execute(query)
+                        existing[archive_table_name] = 'p' if partition_by_month else 'r'
+
+                    if existing[archive_table_name] != 'p':
+                        continue
+
+                    for partition_name, start, end in partitions[table]:
+                        if partition_name in existing:
+                            continue
+
+                        query = SQL(
+                            f"CREATE TABLE {schema}.{partition_name} PARTITION OF {schema}.{archive_table_name} "
+                            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                        )
+                        logging.debug(query)
+                        curs.execute(query)
+
+        self.archive_tables.update(tables)
+
+    def get_create_archive_table_query(self, table_name: str) -> SQL:
+        """
+        Archive table has the same columns as %table_name%, with partition_by_month it also has archive date column
+        (current date by default) and is partitioned by range of it
+        """
+        schema = self.config.db_config.schema
+        archive_table = f"{schema}.{self.get_archive_table_name(table_name)}"
+        if not self.config.archiver_config.partition_by_month:
+            return SQL(f"CREATE TABLE IF NOT EXISTS {archive_table} (LIKE {schema}.{table_name})")
+
+        date_column = self.config.archiver_config.archive_date_column
+        return SQL(
+            f"CREATE TABLE IF NOT EXISTS {archive_table} "
+            f"(LIKE {schema}.{table_name}, {date_column} date NOT NULL DEFAULT CURRENT_DATE) "
+            f"PARTITION BY RANGE ({date_column})"
+        )
+
+    def get_archive_table_name(self, table_name: str) -> str:
+        return f"{table_name}_{self.config.archiver_config.archive_suffix}"
+
+    def get_table_columns(self, table_name: str) -> dict:
+        """
+        Columns of the table (in the order of RETURNING *) and positions of json/jsonb columns, cached for the run
+        Result: {'columns': ['id', 'name', 'data'], 'json_positions': [2]}
+        """
+        if table_name in self.table_columns:
+            return self.table_columns[table_name]
+
+        columns = get_table_columns(self.conn, self.config.db_config.schema, table_name)
+        self.table_columns[table_name] = {
+            'columns': [column['column_name'] for column in columns],
+            'json_positions': [i for i, column in enumerate(columns) if column['type_name'] in JSON_TYPES],
+        }
+        return self.table_columns[table_name]
+
+    def insert_returned_rows(self, curs, table_name: str, archive_table_name: str, tabs: str) -> int:
+        """Move rows, returned by DELETE ... RETURNING * in %curs%, to archive table by chunks"""
+        total_archived_rows = 0
+        rows_chunk = curs.fetchmany(size=self.config.archiver_config.chunk_size)
+        while rows_chunk:
+            total_archived_rows += len(rows_chunk)
+            self.insert_rows(
+                archive_table_name=archive_table_name, table_name=table_name, values=rows_chunk, tabs=tabs
+            )
+            rows_chunk = curs.fetchmany(size=self.config.archiver_config.chunk_size)
+
+        return total_archived_rows
+
+    def insert_rows(self, archive_table_name: str, table_name: str, values: List[tuple], tabs: str):
+        table_columns = self.get_table_columns(table_name)
+        column_names = ', '.join(table_columns['columns'])
         query = SQL(f'INSERT INTO {self.config.db_config.schema}.{archive_table_name} ({column_names}) VALUES %s')
 
-        # Convert dict to json
-        for row in values:
-            for col_name, col_val in row.items():
-                if isinstance(col_val, dict):
-                    row[col_name] = Json(col_val)
-                if isinstance(col_val, list) and col_val and isinstance(col_val[0], dict):
-                    row[col_name] = Json(col_val)
+        # Convert values of json/jsonb columns (dicts, lists, scalars) to json
+        json_positions = table_columns['json_positions']
+        if json_positions:
+            values = [list(row) for row in values]
+            for row in values:
+                for i in json_positions:
+                    if row[i] is not None:
+                        row[i] = Json(row[i])
 
         logging.debug(f"{tabs}INSERT INTO {archive_table_name} - {len(values)} rows")
-        with self.conn.cursor(cursor_factory=DictCursor) as cursor:
-            execute_values(cursor, query.as_string(cursor), values)
+        start = time.monotonic()
+        with self.conn.cursor() as curs:
+            execute_values(curs, query.as_string(curs), values)
 
-    def delete_rows_by_fk(self, cursor, table_name: str, fk: ForeignKey, fk_rows: List, tabs: str):
-        pk_cols = fk.pk_main.split(', ')
-        row_ids = [tuple(row[pk] for pk in pk_cols) for row in fk_rows]
+        if self.profiler:
+            duration_ms = (time.monotonic() - start) * 1000
+            self.profiler.record(archive_table_name, 'insert', '', duration_ms, len(values))
+
+    def delete_rows_by_fk(self, curs, table_name: str, fk: ForeignKey, fk_rows: List[tuple], tabs: str):
         in_s = ', '.join('%s' for _ in range(len(fk_rows)))
 
         query = SQL(
@@ -189,11 +618,9 @@ class Archiver:
         )
 
         logging.debug(f"{tabs}DELETE FROM {table_name} by FK {fk.fk_ref} - {len(fk_rows)} rows")
-        cursor.execute(query, row_ids)
+        self.execute(curs, query, fk_rows, table_name, 'delete_by_fk', fk.fk_ref)
 
-    def delete_rows_by_ids(self, cursor, table_name: str, pk_columns: str, rows: List[dict], tabs: str):
-        pk_cols = [pk.strip() for pk in pk_columns.split(',')]
-        row_ids = [tuple(row[pk] for pk in pk_cols) for row in rows]
+    def delete_rows_by_ids(self, curs, table_name: str, pk_columns: str, rows: List[tuple], tabs: str):
         in_s = ', '.join('%s' for _ in range(len(rows)))
 
         query = SQL(
@@ -202,12 +629,11 @@ class Archiver:
         )
 
         logging.debug(f"{tabs}DELETE FROM {table_name} by {pk_columns} - {len(rows)} rows")
-        cursor.execute(query, row_ids)
+        self.execute(curs, query, rows, table_name, 'delete_by_ids', pk_columns)
 
-    def select_rows_by_fk(self, cursor, table_name: str, fk: ForeignKey, rows: List[dict], tabs: str, for_update: bool = False):
-        pk_cols = fk.pk_main.split(', ')
-        row_ids = [tuple(row[pk] for pk in pk_cols) for row in rows]
-        in_s = ', '.join('%s' for _ in range(len(rows)))
+    def select_rows_by_fk(self, curs, table_name: str, fk: ForeignKey, fk_rows: List[tuple], tabs: str,
+                          for_update: bool = False):
+        in_s = ', '.join('%s' for _ in range(len(fk_rows)))
 
         query = f"SELECT {fk.pk_ref} FROM {self.config.db_config.schema}.{table_name} WHERE ({fk.fk_ref}) IN ({in_s})"
         if for_update:
@@ -215,11 +641,10 @@ class Archiver:
         query = SQL(query)
 
         logging.debug(f"{tabs}{query}"[:1000])
-        cursor.execute(query, row_ids)
+        statement = 'select_for_update_by_fk' if for_update else 'select_by_fk'
+        self.execute(curs, query, fk_rows, table_name, statement, fk.fk_ref)
 
-    def select_rows_for_update(self, cursor, table_name: str, pk_columns: str, rows: List[dict], tabs: str):
-        pk_cols = [pk.strip() for pk in pk_columns.split(',')]
-        row_ids = [tuple(row[pk] for pk in pk_cols) for row in rows]
+    def select_rows_for_update(self, curs, table_name: str, pk_columns: str, rows: List[tuple], tabs: str):
         in_s = ', '.join('%s' for _ in range(len(rows)))
 
         query = SQL(
@@ -228,4 +653,115 @@ class Archiver:
         )
 
         logging.debug(f"{tabs}SELECT {pk_columns} FROM {table_name} FOR UPDATE by {pk_columns} - {len(rows)} rows")
-        cursor.execute(query, row_ids)
+        self.execute(curs, query, rows, table_name, 'select_for_update', pk_columns)
+
+
+def get_discovery_conn(config: Config) -> Optional[connection]:
+    """
+    Replica connection for discovery of referring rows keys, if archive_discovery is set.
+    None - keys are discovered on the primary by the archiving connection
+    """
+    replica_config = config.replica_config
+    if replica_config.enabled and replica_config.archive_discovery:
+        return get_replica_conn(config)
+
+    return None
+
+
+def get_cascade_tables(references: dict) -> Set[str]:
+    """
+    Tables, whose rows can be deleted by ON DELETE CASCADE without client-side traversal:
+    all Foreign Keys referring to the table are ON DELETE SET NULL or ON DELETE CASCADE from such tables
+    (the largest such set, so cycles of CASCADE Foreign Keys are included)
+    """
+    cascade_tables = set(references)
+    changed = True
+    while changed:
+        changed = False
+        for table_name in list(cascade_tables):
+            for ref_table, ref_data in references[table_name].items():
+                if any(
+                    fk.delete_rule not in SERVER_DELETE_RULES
+                    or (fk.delete_rule == 'CASCADE' and ref_table not in cascade_tables)
+                    for fk in ref_data['references']
+                ):
+                    cascade_tables.discard(table_name)
+                    changed = True
+                    break
+
+    return cascade_tables
+
+
+def is_handled_by_server(table_name: str, fk: ForeignKey, cascade_tables: Set[str]) -> bool:
+    """
+    Rows of %table_name%, referring by %fk%, are updated / deleted by the server itself:
+    ON DELETE SET NULL or ON DELETE CASCADE from one of %cascade_tables% (see get_cascade_tables)
+    """
+    if fk.delete_rule not in SERVER_DELETE_RULES:
+        return False
+
+    return fk.delete_rule == 'SET NULL' or table_name in cascade_tables
+
+
+def get_key_values(rows: List[tuple], columns: str, key_columns: str) -> List[tuple]:
+    """
+    Get values of %key_columns% from %rows% (tuples of %columns% values),
+    e.g. values of columns, referenced by Foreign Key, from primary keys of the rows
+    """
+    columns = [col.strip() for col in columns.split(',')]
+    key_columns = [col.strip() for col in key_columns.split(',')]
+    if columns == key_columns:
+        return rows
+
+    positions = [columns.index(col) for col in key_columns]
+    return [tuple(row[i] for i in positions) for row in rows]
+
+
+def get_hierarchy_query(table: str, fks: List[ForeignKey], rows: List[tuple], pk_cols: str):
+    """
+    WITH RECURSIVE query, collecting all descendants of %rows% in %table% (with schema) by self-referencing %fks%
+    (UNION guarantees termination even if data contains cycles)
+    """
+    columns = []
+    for fk in fks:
+        for col in fk.pk_ref.split(', ') + fk.pk_main.split(', '):
+            if col not in columns:
+                columns.append(col)
+
+    start_conditions, join_conditions, row_ids = [], [], []
+    for fk in fks:
+        start_conditions.append(f"({fk.fk_ref}) IN ({', '.join('%s' for _ in rows)})")
+        row_ids += get_key_values(rows, pk_cols, fk.pk_main)
+
+        fk_cols, pk_main_cols = fk.fk_ref.split(', '), fk.pk_main.split(', ')
+        join_conditions.append(
+            f"({', '.join(f'c.{col}' for col in fk_cols)}) = ({', '.join(f'h.{col}' for col in pk_main_cols)})"
+        )
+
+    query = (
+        f"WITH RECURSIVE hierarchy AS ("
+        f"SELECT {', '.join(columns)} FROM {table} WHERE {' OR '.join(start_conditions)} "
+        f"UNION "
+        f"SELECT {', '.join(f'c.{col}' for col in columns)} FROM {table} c "
+        f"INNER JOIN hierarchy h ON {' OR '.join(join_conditions)})"
+    )
+    return query, row_ids
+
+
+def get_advisory_lock_key(table_name: str, row: tuple) -> int:
+    """Stable (across processes) signed 64-bit advisory lock key of the bucket of the row primary key"""
+    bucket = int(hashlib.md5(repr(row).encode()).hexdigest(), 16) % ADVISORY_LOCK_BUCKETS
+    digest = hashlib.md5(f'pggraph:{table_name}:{bucket}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def get_month_partitions(archive_table_name: str, today: date) -> List[Tuple[str, date, date]]:
+    """Monthly partitions of archive table for current and next month: [(partition_name, start, end)]"""
+    partitions = []
+    start = today.replace(day=1)
+    for _ in range(2):
+        end = (start + timedelta(days=32)).replace(day=1)
+        partitions.append((f"{archive_table_name}_{start:%Y%m}", start, end))
+        start = end
+
+    return partitions
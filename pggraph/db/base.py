@@ -3,6 +3,7 @@ Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Lice
 Please, see the LICENSE.md file in project's root for full licensing information.
 """
 import logging
+from typing import List
 
 import psycopg2
 from psycopg2._psycopg import connection
@@ -11,6 +12,14 @@ from psycopg2.extras import DictCursor, LoggingConnection
 from pggraph.config import Config
 
 
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) * 1000, 0)
+    END;
+""".strip()
+
+
 def get_db_conn(config: Config, with_db: bool = True, with_schema: bool = False) -> connection:
     db_config_dict = config.db_config.as_dict().copy()
     if not with_db:
@@ -18,7 +27,73 @@ def get_db_conn(config: Config, with_db: bool = True, with_schema: bool = False)
     if not with_schema:
         db_config_dict.pop('schema')
 
-    conn = psycopg2.connect(**db_config_dict, cursor_factory=DictCursor, connection_factory=LoggingConnection)
-    conn.initialize(logging.getLogger())
+    return connect(db_config_dict)
+
+
+def get_replica_conn(config: Config) -> connection:
+    """
+    Read-only autocommit connection for queries, which don't modify data (graph loading, references lookups).
+    Connection to the replica if it is enabled, available and lags behind the primary not more than max_lag_ms,
+    otherwise to the primary
+    """
+    replica_config = config.replica_config
+    if replica_config.enabled:
+        db_config_dict = {
+            field: getattr(replica_config, field) or getattr(config.db_config, field)
+            for field in ('host', 'port', 'user', 'password', 'dbname')
+        }
+        try:
+            conn = connect(db_config_dict)
+        except psycopg2.OperationalError as error:
+            logging.warning(f'Replica {replica_config.host} is unavailable, using primary: {str(error).strip()}')
+        else:
+            lag_ms = get_replica_lag(conn)
+            if not replica_config.max_lag_ms or lag_ms <= replica_config.max_lag_ms:
+                conn.set_session(readonly=True, autocommit=True)
+                return conn
 
+            logging.warning(f'Replica {replica_config.host} lags {lag_ms:.0f} ms behind, using primary')
+            conn.close()
+
+    conn = get_db_conn(config)
+    conn.set_session(readonly=True, autocommit=True)
     return conn
+
+
+def get_replica_lag(conn) -> float:
+    """Replication lag in ms (0 if the server isn't a replica or has replayed all received WAL)"""
+    with conn, conn.cursor() as curs:
+        curs.execute(REPLICA_LAG_QUERY)
+        return float(curs.fetchone()[0])
+
+
+def connect(db_config_dict: dict) -> connection:
+    # LoggingConnection formats every query (with all parameters), so it is used only if queries will be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        conn = psycopg2.connect(**db_config_dict, cursor_factory=DictCursor, connection_factory=LoggingConnection)
+        conn.initialize(logging.getLogger())
+    else:
+        conn = psycopg2.connect(**db_config_dict, cursor_factory=DictCursor)
+
+    return conn
+
+
+def get_table_columns(conn, schema: str, table_name: str) -> List[dict]:
+    """
+    Columns of the table in physical order (the order of SELECT * / RETURNING *)
+    identity - 'a' (GENERATED ALWAYS AS IDENTITY), 'd' (BY DEFAULT) or '', generated - 's' (stored generated) or ''
+    """
+    query = """
+        SELECT a.attname AS column_name,
+               t.typname AS type_name,
+               format_type(a.atttypid, a.atttypmod) AS column_type,
+               a.attidentity::text AS identity,
+               COALESCE(to_jsonb(a)->>'attgenerated', '') AS generated  -- attgenerated appeared in PostgreSQL 12
+        FROM pg_attribute a
+        INNER JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum;
+    """
+    with conn.cursor(cursor_factory=DictCursor) as curs:
+        curs.execute(query.strip(), (f"{schema}.{table_name}", ))
+        return [dict(row) for row in curs.fetchall()]
@@ -2,8 +2,12 @@
 Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
 Please, see the LICENSE.md file in project's root for full licensing information.
 """
+import hashlib
 import logging
+import time
+import tracemalloc
 from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Set, Dict, List
 
 from psycopg2._psycopg import connection
@@ -11,12 +15,26 @@ from psycopg2.extras import DictCursor
 
 from pggraph.config import Config, DBConfig
 from pggraph.utils.classes.foreign_key import ForeignKey
-from pggraph.db.base import get_db_conn
-
-
-def build_references(config: Config, conn: connection = None) -> Dict[str, dict]:
+from pggraph.db.base import get_replica_conn
+
+CATALOG_STATE_QUERY = """
+    SELECT c.relname::text AS table_name,
+           c.xmin::text || ':' || coalesce(
+               string_agg(con.oid::text || ':' || con.xmin::text, ',' ORDER BY con.oid), ''
+           ) AS marker
+    FROM pg_class c
+    INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_constraint con ON (con.conrelid = c.oid OR con.confrelid = c.oid) AND con.contype IN ('p', 'f')
+    WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p')
+    GROUP BY c.oid, c.relname, c.xmin::text
+""".strip()
+
+
+def build_references(config: Config, conn: connection = None, profile: bool = False) -> Dict[str, dict]:
     """
     Build a tables dependency graph
+    With %profile% the result also contains build profile: duration of catalog queries and graph construction,
+    peak memory allocated by graph construction (tracemalloc) and size of the graph (see get_graph_stats)
 
     Algorithm:
     1) Get all table names
@@ -48,58 +66,250 @@ def build_references(config: Config, conn: connection = None) -> Dict[str, dict]
             'table_a': 'id',
             'table_b': 'id',
             'table_c': 'id'
+        },
+        'catalog_state': {
+            'marker': '9e107d9d372bb6826bd81d3542a419d6',
+            'tables': {'table_a': '1234:16390:1234', ...}
+        },
+        'profile': {  # only with %profile%
+            'timings_ms': {'get_catalog_state': 5.1, 'get_all_tables': 2.3, 'get_all_fk': 40.2, 'get_all_pk': 3.5,
+                           'build_graph': 120.7},
+            'memory_peak_kb': 2048.5,
+            'tables': 3, 'foreign_keys': 4, 'edges': 3, 'nested_nodes': 5,
+            'top_tables': [{'table': 'table_a', 'referring_tables': 2, 'nested_nodes': 3}, ...]
         }
     }
     """
 
     if not conn:
-        conn = get_db_conn(config)
+        conn = get_replica_conn(config)
 
+    timings = {}
     try:
         references = {}
-        tables = get_all_tables(conn, config.db_config)
-        foreign_keys = get_all_fk(conn, config.db_config)
-        primary_keys = get_all_pk(conn, config.db_config)
-
-        for table in tables:
-            references[table['table_name']] = {}
-
-        for fk in foreign_keys:
-            if fk['main_table'] not in references:
-                references[fk['main_table']] = {}
-
-            if not fk['ref_table'] in references[fk['main_table']]:
-                references[fk['main_table']][fk['ref_table']] = {
-                    'ref_tables': {},
-                    'references': []
-                }
-
-            table_references = references[fk['main_table']][fk['ref_table']]['references']
-            table_references.append(ForeignKey(
-                pk_main=fk['main_table_column'],
-                pk_ref=fk['ref_pk_columns'],
-                fk_ref=fk['ref_fk_column'],
-                fk_name=fk['constraint_name'],
-            ))
-
-        if references:
-            references = OrderedDict(sorted(references.items(), key=lambda row: len(row[1]), reverse=True))
-
-        for parent, refs in references.items():
-            for ref, ref_data in refs.items():
-                visited = {parent, ref}
-                ref_childs = ref_data['ref_tables']
-                recursive_build(ref, ref_childs, references, visited)
+        with measure(timings, 'get_catalog_state'):
+            catalog_state = get_catalog_state(conn, config.db_config)
+        with measure(timings, 'get_all_tables'):
+            tables = get_all_tables(conn, config.db_config)
+        with measure(timings, 'get_all_fk'):
+            foreign_keys = get_all_fk(conn, config.db_config)
+        with measure(timings, 'get_all_pk'):
+            primary_keys = get_all_pk(conn, config.db_config)
+
+        # tracing slows down allocations, so memory is traced only in profile mode
+        trace_memory = profile and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        elif profile:
+            # peak of the trace, which is already running, can be reached before the build
+            if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.stop()
+                tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0] if profile else 0
+
+        with measure(timings, 'build_graph'):
+            for table in tables:
+                references[table['table_name']] = {}
+
+            for fk in foreign_keys:
+                add_foreign_key(references, fk)
+
+            if references:
+                references = OrderedDict(sorted(references.items(), key=lambda row: len(row[1]), reverse=True))
+
+            for parent, refs in references.items():
+                for ref, ref_data in refs.items():
+                    build_ref_tables(references, parent, ref, ref_data)
+
+        memory_peak = tracemalloc.get_traced_memory()[1] - memory_before if profile else 0
+        if trace_memory:
+            tracemalloc.stop()
     finally:
         conn.close()
 
+    logging.debug(f'References built: {timings}')
     result = {
         'references': references,
-        'primary_keys': primary_keys
+        'primary_keys': primary_keys,
+        'catalog_state': catalog_state,
     }
+    if profile:
+        result['profile'] = {
+            'timings_ms': timings,
+            'memory_peak_kb': round(memory_peak / 1024, 1),
+            **get_graph_stats(references, top=config.profiler_config.top),
+        }
+
     return result
 
 
+@contextmanager
+def measure(timings: Dict[str, float], name: str):
+    start = time.monotonic()
+    yield
+    timings[name] = round((time.monotonic() - start) * 1000, 1)
+
+
+def get_graph_stats(references: Dict[str, dict], top: int = 10) -> dict:
+    """
+    Size of the graph: tables, Foreign Keys, edges between tables and nodes of nested ref_tables subtrees
+    (expansion of the graph into trees, grows exponentially with fan-out and depth of the graph),
+    %top% tables with the largest subtrees
+    """
+    nested_nodes = {}
+    for table_name, refs in references.items():
+        nodes_count = 0
+        stack = [ref_data['ref_tables'] for ref_data in refs.values()]
+        while stack:
+            ref_tables = stack.pop()
+            nodes_count += len(ref_tables)
+            stack.extend(childs for childs in ref_tables.values() if isinstance(childs, dict))
+        nested_nodes[table_name] = nodes_count
+
+    top_tables = sorted(nested_nodes, key=lambda table_name: (-nested_nodes[table_name], table_name))[:top]
+    return {
+        'tables': len(references),
+        'foreign_keys': sum(len(ref_data['references']) for refs in references.values() for ref_data in refs.values()),
+        'edges': sum(len(refs) for refs in references.values()),
+        'nested_nodes': sum(nested_nodes.values()),
+        'top_tables': [
+            {
+                'table': table_name,
+                'referring_tables': len(references[table_name]),
+                'nested_nodes': nested_nodes[table_name],
+            }
+            for table_name in top_tables
+        ],
+    }
+
+
+def refresh_references(config: Config,
+                       references: Dict[str, dict],
+                       primary_keys: Dict[str, str],
+                       catalog_state: dict,
+                       conn: connection = None) -> dict:
+    """
+    Patch %references% and %primary_keys% in place with tables changed since %catalog_state% was taken
+
+    Algorithm:
+    1) Compare catalog marker of the schema, return if nothing changed
+    2) Compare catalog markers of each table (pg_class row and its PK/FK constraints) - get changed tables
+    3) Remove changed tables and all their edges from the graph,
+       load Foreign Keys and Primary Keys only for changed tables and add them back
+    4) Rebuild ref_tables only for edges, which can reach changed tables
+
+    Result:
+    {
+        'catalog_state': {'marker': '...', 'tables': {'table_a': '...', ...}},
+        'changed_tables': ['table_a', 'table_d']
+    }
+    """
+    if not conn:
+        conn = get_replica_conn(config)
+
+    try:
+        if get_catalog_marker(conn, config.db_config) == catalog_state['marker']:
+            return {'catalog_state': catalog_state, 'changed_tables': []}
+
+        new_catalog_state = get_catalog_state(conn, config.db_config)
+        old_tables, new_tables = catalog_state['tables'], new_catalog_state['tables']
+        changed_tables = sorted(
+            table for table in set(old_tables) | set(new_tables) if old_tables.get(table) != new_tables.get(table)
+        )
+        if not changed_tables:
+            return {'catalog_state': new_catalog_state, 'changed_tables': []}
+
+        foreign_keys = get_all_fk(conn, config.db_config, tables=changed_tables)
+        changed_primary_keys = get_all_pk(conn, config.db_config, tables=changed_tables)
+    finally:
+        conn.close()
+
+    affected_tables = get_tables_reaching(references, changed_tables)
+
+    for table in changed_tables:
+        references.pop(table, None)
+        primary_keys.pop(table, None)
+        for refs in references.values():
+            refs.pop(table, None)
+
+        if table in new_tables:
+            references[table] = {}
+
+    for fk in foreign_keys:
+        add_foreign_key(references, fk)
+    primary_keys.update(changed_primary_keys)
+
+    affected_tables |= get_tables_reaching(references, changed_tables)
+    for parent, refs in references.items():
+        for ref, ref_data in refs.items():
+            if parent in affected_tables or ref in affected_tables:
+                ref_data['ref_tables'] = {}
+                build_ref_tables(references, parent, ref, ref_data)
+
+    logging.info(f'References refreshed, changed tables: {changed_tables}')
+    return {'catalog_state': new_catalog_state, 'changed_tables': changed_tables}
+
+
+def copy_references(references: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Copy of %references%, which can be patched by refresh_references without changing the original
+    (ref_tables are replaced by refresh_references, not patched, so they are shared)
+    """
+    return {
+        table: {
+            ref_table: {'ref_tables': ref_data['ref_tables'], 'references': list(ref_data['references'])}
+            for ref_table, ref_data in refs.items()
+        }
+        for table, refs in references.items()
+    }
+
+
+def add_foreign_key(references: Dict[str, dict], fk: dict):
+    if fk['main_table'] not in references:
+        references[fk['main_table']] = {}
+
+    if not fk['ref_table'] in references[fk['main_table']]:
+        references[fk['main_table']][fk['ref_table']] = {
+            'ref_tables': {},
+            'references': []
+        }
+
+    table_references = references[fk['main_table']][fk['ref_table']]['references']
+    table_references.append(ForeignKey(
+        pk_main=fk['main_table_column'],
+        pk_ref=fk['ref_pk_columns'],
+        fk_ref=fk['ref_fk_column'],
+        fk_name=fk['constraint_name'],
+        delete_rule=fk['delete_rule'],
+    ))
+
+
+def build_ref_tables(references: Dict[str, dict], parent: str, ref: str, ref_data: dict):
+    visited = {parent, ref}
+    ref_childs = ref_data['ref_tables']
+    recursive_build(ref, ref_childs, references, visited)
+
+
+def get_tables_reaching(references: Dict[str, dict], tables: List[str]) -> Set[str]:
+    """Get %tables% and all tables referred by them directly or transitively"""
+    referred_by = {}
+    for parent, refs in references.items():
+        for ref in refs:
+            referred_by.setdefault(ref, set()).add(parent)
+
+    reaching = set(tables)
+    stack = list(tables)
+    while stack:
+        for parent in referred_by.get(stack.pop(), ()):
+            if parent not in reaching:
+                reaching.add(parent)
+                stack.append(parent)
+
+    return reaching
+
+
 def recursive_build(parent_table: str,
                     parent_childs: dict,
                     references: Dict[str, dict],
@@ -133,6 +343,37 @@ def recursive_build(parent_table: str,
     return parent_childs
 
 
+def get_catalog_marker(conn, db_config: DBConfig) -> str:
+    """Single marker of all tables and their PK/FK constraints in schema, changes on any DDL affecting the graph"""
+    query = f"""
+        SELECT md5(coalesce(string_agg(marker, ',' ORDER BY table_name COLLATE "C"), '')) AS marker
+        FROM ({CATALOG_STATE_QUERY}) s
+    """
+
+    with conn.cursor(cursor_factory=DictCursor) as curs:
+        curs.execute(query.strip(), {'schema': db_config.schema})
+        return curs.fetchone()['marker']
+
+
+def get_catalog_state(conn, db_config: DBConfig) -> dict:
+    """
+    Catalog markers (xmin of pg_class/pg_constraint rows) of all tables in schema
+
+    Result:
+    {
+        'marker': '9e107d9d372bb6826bd81d3542a419d6',
+        'tables': {'table_a': '1234:16390:1234', 'table_b': '1240:'}
+    }
+    """
+    with conn.cursor(cursor_factory=DictCursor) as curs:
+        curs.execute(CATALOG_STATE_QUERY, {'schema': db_config.schema})
+        result = curs.fetchall()
+
+    tables = {row['table_name']: row['marker'] for row in result}
+    marker = hashlib.md5(','.join(tables[table] for table in sorted(tables)).encode()).hexdigest()
+    return {'marker': marker, 'tables': tables}
+
+
 def get_all_tables(conn, db_config: DBConfig) -> List[dict]:
     query = "SELECT * FROM information_schema.tables WHERE table_type = 'BASE TABLE' AND table_schema = %(schema)s"
 
@@ -144,7 +385,8 @@ def get_all_tables(conn, db_config: DBConfig) -> List[dict]:
     return base_tables
 
 
-def get_all_fk(conn, db_config: DBConfig) -> List[dict]:
+def get_all_fk(conn, db_config: DBConfig, tables: List[str] = None) -> List[dict]:
+    """Get all Foreign Keys in schema (only Foreign Keys from or to %tables%, if set)"""
     query = """
         WITH contraints_columns_table AS (
             SELECT main_table_name,
@@ -183,10 +425,16 @@ def get_all_fk(conn, db_config: DBConfig) -> List[dict]:
             tc.table_name AS ref_table,
             pk_table.column_name AS ref_pk_columns,
             kcu.column_name AS ref_fk_column,
-            ccu.constraint_name as constraint_name
+            ccu.constraint_name as constraint_name,
+            rc.delete_rule AS delete_rule
         
         FROM information_schema.table_constraints tc
         
+        INNER JOIN information_schema.referential_constraints rc
+            ON rc.constraint_catalog = tc.constraint_catalog
+            AND rc.constraint_schema = tc.constraint_schema
+            AND rc.constraint_name = tc.constraint_name
+        
         LEFT JOIN (
             select ccu_in.constraint_catalog, ccu_in.constraint_schema, ccu_in.constraint_name,
                    cct.main_table_name, cct.column_name
@@ -216,19 +464,24 @@ def get_all_fk(conn, db_config: DBConfig) -> List[dict]:
         WHERE lower(tc.constraint_type) in ('foreign key') 
             AND tc.constraint_schema = %(schema)s 
             AND ccu.main_table_name is not null
-        GROUP BY ccu.main_table_name, ccu.column_name, pk_table.column_name, tc.table_name, kcu.column_name, ccu.constraint_name
+            AND (%(tables)s::text[] IS NULL
+                 OR ccu.main_table_name::text = ANY(%(tables)s::text[])
+                 OR tc.table_name::text = ANY(%(tables)s::text[]))
+        GROUP BY ccu.main_table_name, ccu.column_name, pk_table.column_name, tc.table_name, kcu.column_name,
+                 ccu.constraint_name, rc.delete_rule
         ORDER BY ccu.main_table_name, tc.table_name;
     """
 
     with conn.cursor(cursor_factory=DictCursor) as curs:
-        curs.execute(query.strip(), {'schema': db_config.schema})
+        curs.execute(query.strip(), {'schema': db_config.schema, 'tables': tables})
         result = curs.fetchall()
 
     foreign_keys = [dict(row) for row in result]
     return foreign_keys
 
 
-def get_all_pk(conn, db_config: DBConfig) -> Dict[str, str]:
+def get_all_pk(conn, db_config: DBConfig, tables: List[str] = None) -> Dict[str, str]:
+    """Get Primary Keys of all tables in schema (only of %tables%, if set)"""
     query = """
         select kcu.table_name as table_name, string_agg(distinct kcu.column_name, ', ') as column_names
         from information_schema.key_column_usage kcu
@@ -237,10 +490,11 @@ def get_all_pk(conn, db_config: DBConfig) -> Dict[str, str]:
               AND tc_in.constraint_schema = kcu.constraint_schema
               AND tc_in.constraint_catalog = kcu.constraint_catalog
         where tc_in.constraint_type = 'PRIMARY KEY' AND tc_in.table_schema = %(schema)s
+          AND (%(tables)s::text[] IS NULL OR kcu.table_name::text = ANY(%(tables)s::text[]))
         group by kcu.table_name, kcu.constraint_catalog, kcu.constraint_schema, kcu.constraint_name;
     """
     with conn.cursor(cursor_factory=DictCursor) as curs:
-        curs.execute(query.strip(), {'schema': db_config.schema})
+        curs.execute(query.strip(), {'schema': db_config.schema, 'tables': tables})
         result = curs.fetchall()
 
     primary_keys = [dict(row) for row in result]
@@ -0,0 +1,121 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+from typing import Dict, List, Set
+
+from psycopg2.extras import DictCursor
+
+from pggraph.config import DBConfig
+
+MAX_IDENTIFIER_LENGTH = 63
+
+
+def get_missing_fk_indexes(conn, db_config: DBConfig, references: Dict[str, dict],
+                           tables: Set[str] = None) -> List[dict]:
+    """
+    Find Foreign Keys whose columns are not covered by the leading columns of any valid index
+    of the referring table. Deleting/selecting rows by such Foreign Key means sequential scan.
+
+    :param tables: check only edges going from these tables (all tables if None)
+
+    Result (sorted by table size, biggest first):
+    [
+        {
+            'table': 'table_b',
+            'columns': 'table_a_id',
+            'referenced_table': 'table_a',
+            'fk_name': 'table_b_table_a_id_fkey',
+            'estimated_rows': 1000000,
+            'table_size_bytes': 73728000,
+            'table_size': '70 MB',
+            'create_index': 'CREATE INDEX CONCURRENTLY IF NOT EXISTS table_b_table_a_id_idx ON public.table_b (table_a_id);'
+        },
+        ...
+    ]
+    """
+    indexes = get_all_indexes(conn, db_config)
+    tables_size = get_tables_size(conn, db_config)
+
+    missing_indexes = []
+    for main_table, refs in references.items():
+        if tables is not None and main_table not in tables:
+            continue
+
+        for ref_table, ref_data in refs.items():
+            for fk in ref_data['references']:
+                fk_columns = [col.strip() for col in fk.fk_ref.split(',')]
+                if has_usable_index(indexes.get(ref_table, []), fk_columns):
+                    continue
+
+                size = tables_size.get(ref_table, {})
+                missing_indexes.append({
+                    'table': ref_table,
+                    'columns': fk.fk_ref,
+                    'referenced_table': main_table,
+                    'fk_name': fk.fk_name,
+                    'estimated_rows': size.get('estimated_rows'),
+                    'table_size_bytes': size.get('table_size_bytes'),
+                    'table_size': size.get('table_size'),
+                    'create_index': get_create_index_query(db_config.schema, ref_table, fk_columns),
+                })
+
+    missing_indexes.sort(key=lambda row: row['table_size_bytes'] or 0, reverse=True)
+    return missing_indexes
+
+
+def has_usable_index(table_indexes: List[List[str]], fk_columns: List[str]) -> bool:
+    """Index is usable for FK lookups if its leading columns are exactly the FK columns (in any order)"""
+    for index_columns in table_indexes:
+        if set(index_columns[:len(fk_columns)]) == set(fk_columns):
+            return True
+
+    return False
+
+
+def get_create_index_query(schema: str, table_name: str, columns: List[str]) -> str:
+    index_name = f"{table_name}_{'_'.join(columns)}_idx"[:MAX_IDENTIFIER_LENGTH]
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {schema}.{table_name} ({', '.join(columns)});"
+
+
+def get_all_indexes(conn, db_config: DBConfig) -> Dict[str, List[List[str]]]:
+    """Columns of all valid non-partial indexes: {table_name: [[col_1, col_2], [col_3]]}"""
+    query = """
+        SELECT t.relname AS table_name,
+               array_agg(a.attname::text ORDER BY k.ord) AS column_names
+        FROM pg_index i
+        INNER JOIN pg_class t ON t.oid = i.indrelid
+        INNER JOIN pg_namespace n ON n.oid = t.relnamespace
+        CROSS JOIN LATERAL unnest(i.indkey::smallint[]) WITH ORDINALITY AS k(attnum, ord)
+        LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE n.nspname = %(schema)s AND i.indisvalid AND i.indpred IS NULL
+        GROUP BY t.relname, i.indexrelid;
+    """
+
+    with conn.cursor(cursor_factory=DictCursor) as curs:
+        curs.execute(query.strip(), {'schema': db_config.schema})
+        result = curs.fetchall()
+
+    indexes = {}
+    for row in result:
+        indexes.setdefault(row['table_name'], []).append(row['column_names'])
+
+    return indexes
+
+
+def get_tables_size(conn, db_config: DBConfig) -> Dict[str, dict]:
+    query = """
+        SELECT c.relname AS table_name,
+               NULLIF(c.reltuples, -1)::bigint AS estimated_rows,
+               pg_total_relation_size(c.oid) AS table_size_bytes,
+               pg_size_pretty(pg_total_relation_size(c.oid)) AS table_size
+        FROM pg_class c
+        INNER JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %(schema)s AND c.relkind IN ('r', 'p');
+    """
+
+    with conn.cursor(cursor_factory=DictCursor) as curs:
+        curs.execute(query.strip(), {'schema': db_config.schema})
+        result = curs.fetchall()
+
+    return {row['table_name']: dict(row) for row in result}
@@ -0,0 +1,99 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict
+
+from psycopg2.sql import SQL
+
+from pggraph.config import Config
+from pggraph.db.base import get_db_conn
+
+MODE_BATCHES = 'batches'
+MODE_END = 'end'
+
+
+class MaintenanceScheduler:
+    """
+    VACUUM (ANALYZE) / ANALYZE of tables with many rows deleted by archiving (dead tuples, stale statistics).
+    Deleted rows are tracked per table, tables with more than threshold_rows deleted rows since their last
+    maintenance are processed in background threads (at most %workers% at once) with own autocommit connections:
+    between root chunks (mode = batches) or at the end of the run (mode = end)
+    """
+    config: Config
+    pending_rows: Dict[str, int]
+    tracked_rows: Dict[str, int]
+    maintained_tables: Dict[str, int]
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.pending_rows = defaultdict(int)  # deleted rows since last maintenance of the table
+        self.tracked_rows = defaultdict(int)  # deleted rows already counted in pending_rows
+        self.maintained_tables = defaultdict(int)  # how many times the table was maintained in this run
+        self.running = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.maintenance_config.workers, thread_name_prefix='pggraph-maintenance'
+        )
+
+    def track(self, deleted_rows: Dict[str, int]):
+        """Update pending rows by total deleted rows of the run (Archiver.deleted_rows)"""
+        for table_name, rows_count in deleted_rows.items():
+            self.pending_rows[table_name] += rows_count - self.tracked_rows[table_name]
+            self.tracked_rows[table_name] = rows_count
+
+    def on_batch(self, deleted_rows: Dict[str, int]):
+        """Called after each root chunk"""
+        self.track(deleted_rows)
+        if self.config.maintenance_config.mode == MODE_BATCHES:
+            self.run_due()
+
+    def run_due(self):
+        """Start maintenance of tables with enough pending rows (unless it is already running for the table)"""
+        for table_name, rows_count in list(self.pending_rows.items()):
+            if rows_count < self.config.maintenance_config.threshold_rows:
+                continue
+
+            with self.lock:
+                if table_name in self.running and not self.running[table_name].done():
+                    continue
+
+                self.pending_rows[table_name] = 0
+                self.running[table_name] = self.executor.submit(self.maintain, table_name, rows_count)
+
+    def finish(self) -> Dict[str, int]:
+        """
+        Maintain the rest of tables and wait for all maintenance, returns {table_name: times maintained}.
+        Tables, which got enough pending rows while their maintenance was running, are maintained again
+        """
+        while True:
+            self.run_due()
+            with self.lock:
+                running = [future for future in self.running.values() if not future.done()]
+            if not running:
+                break
+
+            wait(running)
+
+        self.executor.shutdown(wait=True)
+        return dict(self.maintained_tables)
+
+    def maintain(self, table_name: str, rows_count: int):
+        command = 'VACUUM (ANALYZE)' if self.config.maintenance_config.vacuum else 'ANALYZE'
+        logging.info(f'{table_name} - {command} after {rows_count} deleted rows')
+
+        conn = get_db_conn(self.config)
+        conn.autocommit = True  # VACUUM can't run inside transaction block
+        try:
+            with conn.cursor() as curs:
+                curs.execute(SQL(f'{command} {self.config.db_config.schema}.{table_name}'))
+            with self.lock:
+                self.maintained_tables[table_name] += 1
+        except Exception:
+            logging.exception(f'{table_name} - {command} failed')
+        finally:
+            conn.close()
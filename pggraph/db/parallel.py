@@ -0,0 +1,90 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing.util import Finalize
+from typing import Dict, List, Callable, Iterable, Tuple
+
+from pggraph.config import Config
+from pggraph.db.archiver import Archiver, get_discovery_conn
+from pggraph.db.base import get_db_conn
+
+_archiver = None  # Archiver of the worker process, see init_worker
+
+
+def init_worker(config: Config, references: dict):
+    """
+    Initializer of worker process: own connection and Archiver (with advisory locks) for all its chunks.
+    Connections are closed, when the worker exits on pool shutdown (multiprocessing finalizer:
+    worker processes exit by os._exit, so atexit handlers aren't called there)
+    """
+    global _archiver
+    _archiver = Archiver(
+        get_db_conn(config), references, config, advisory_locks=True, read_conn=get_discovery_conn(config)
+    )
+    Finalize(None, close_worker, exitpriority=0)
+
+
+def close_worker():
+    """Close connections of the worker process Archiver"""
+    _archiver.conn.close()
+    if _archiver.read_conn is not _archiver.conn:
+        _archiver.read_conn.close()
+
+
+def archive_chunk(table_name: str, rows: List[tuple], pk_cols: str) -> dict:
+    """Archive chunk of root rows in worker process, returns stats of the chunk"""
+    _archiver.reset_stats()
+    try:
+        _archiver.archive_root(table_name, rows, pk_cols)
+        _archiver.retry_deferred()
+        _archiver.commit_pending()
+    except Exception:
+        _archiver.rollback_pending()
+        raise
+
+    return _archiver.get_stats()
+
+
+def archive_parallel(config: Config, references: dict, roots_chunks: List[Tuple[str, Iterable[List[tuple]]]],
+                     primary_keys: Dict[str, str], on_batch: Callable[[Dict[str, int]], None] = None) -> dict:
+    """
+    Archive chunks of root rows ([(table_name, chunks)]) in %workers% processes.
+    Each process has its own connection and Archiver, so rows shared by chunks of different workers are
+    deduplicated only inside each worker (for the rest of workers they are already archived).
+    At most 2 chunks per worker are queued, stats of all chunks are merged
+    (%on_batch% is called with total deleted rows after finished chunks are merged)
+    """
+    workers = config.archiver_config.workers
+    stats = {'deleted_rows': {}, 'skipped_rows': {}, 'blocked_rows': {}}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config, references)) as pool:
+        in_flight = set()
+        for table_name, rows_chunks in roots_chunks:
+            logging.info(f'{table_name} - START ({workers} workers)')
+            for rows_chunk in rows_chunks:
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    merge_stats(stats, [future.result() for future in done])
+                    if on_batch:
+                        on_batch(stats['deleted_rows'])
+
+                in_flight.add(pool.submit(archive_chunk, table_name, rows_chunk, primary_keys[table_name]))
+
+        merge_stats(stats, [future.result() for future in wait(in_flight).done])
+        if on_batch and in_flight:
+            on_batch(stats['deleted_rows'])
+
+    return stats
+
+
+def merge_stats(stats: dict, chunks_stats: List[dict]):
+    for chunk_stats in chunks_stats:
+        for stat_name in ('deleted_rows', 'skipped_rows'):
+            for table_name, rows_count in chunk_stats[stat_name].items():
+                stats[stat_name][table_name] = stats[stat_name].get(table_name, 0) + rows_count
+
+        for table_name, rows in chunk_stats['blocked_rows'].items():
+            stats['blocked_rows'].setdefault(table_name, []).extend(rows)
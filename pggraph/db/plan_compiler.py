@@ -0,0 +1,237 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+from collections import deque
+from typing import Dict, List, Set, Tuple
+
+from pggraph.config import Config
+from pggraph.db.archiver import get_cascade_tables, is_handled_by_server
+from pggraph.db.base import get_table_columns
+from pggraph.utils.classes.foreign_key import ForeignKey
+from pggraph.utils.reachability import get_subtree_tables
+
+MAX_IDENTIFIER_LENGTH = 63
+FUNCTION_PREFIX = 'pggraph_archive_'
+
+
+def get_archive_function_name(table_name: str) -> str:
+    return f"{FUNCTION_PREFIX}{table_name}"[:MAX_IDENTIFIER_LENGTH]
+
+
+def compile_archive_function(conn, config: Config, references: Dict[str, dict], primary_keys: Dict[str, str],
+                             table_name: str) -> str:
+    """
+    Compile archiving of %table_name% rows with all referring rows into PL/pgSQL function
+    %schema%.pggraph_archive_<table_name>(ids <pk type>[]) RETURNS jsonb ({table_name: deleted_rows}).
+
+    Algorithm of the function (the whole chunk in one call and one transaction):
+        - Collect keys of rows to be archived into temp tables, from the root table down to referring tables
+          (tables in cycles, including self-references, are repeated until no new keys are found)
+        - Tables without referring tables don't need keys, they are archived directly by Foreign Keys
+        - Move rows to archive tables (or just delete them if to_archive = false) from referring tables up to the root
+        - In delete-only mode edges with ON DELETE SET NULL / CASCADE are left to the server, like in Archiver
+
+    Unlike Archiver, the whole subtree is archived regardless of max_depth.
+    Archive tables aren't created by the function, they are provisioned before each run by archive_table_by_plan
+    (see Archiver.provision_archive_tables), so partition_by_month is respected.
+    Function is generated from the current graph and columns, it should be recompiled after schema changes.
+    """
+    pk_columns = primary_keys.get(table_name)
+    if not pk_columns:
+        raise KeyError(f'Primary key for table {table_name} not found')
+    if ',' in pk_columns:
+        raise ValueError(f'Table {table_name} has composite primary key ({pk_columns}), it can\'t be compiled')
+
+    schema = config.db_config.schema
+    to_archive = config.archiver_config.to_archive
+    tables, has_cycles = get_topological_order(references, table_name)
+
+    edges = get_edges(references, tables)
+    if not to_archive:
+        cascade_tables = get_cascade_tables(references)
+        edges = [(parent, child, fk) for parent, child, fk in edges
+                 if not is_handled_by_server(child, fk, cascade_tables)]
+        reached_tables = get_reached_tables(table_name, edges)
+        tables = [table for table in tables if table in reached_tables]
+        edges = [edge for edge in edges if edge[0] in reached_tables]
+
+    parent_tables = {parent for parent, _, _ in edges}
+    key_tables = {}
+    for table in tables:
+        if table in parent_tables or table == table_name:
+            if not primary_keys.get(table):
+                raise KeyError(f'Primary key for table {table} not found')
+            key_tables[table] = f"_pggraph_keys_{len(key_tables)}"
+
+    root_columns = {column['column_name']: column for column in get_table_columns(conn, schema, table_name)}
+    ids_type = root_columns[pk_columns]['column_type']
+
+    body = ["DROP TABLE IF EXISTS {};".format(', '.join(key_tables.values()))] if key_tables else []
+    for table, key_table in key_tables.items():
+        body += [
+            f"-- keys of {table}",
+            f"CREATE TEMP TABLE {key_table} ON COMMIT DROP AS "
+            f"SELECT {primary_keys[table]} FROM {schema}.{table} WITH NO DATA;",
+            f"ALTER TABLE {key_table} ADD PRIMARY KEY ({primary_keys[table]});",
+        ]
+
+    body += [
+        "",
+        f"INSERT INTO {key_tables[table_name]} ({pk_columns}) "
+        f"SELECT {pk_columns} FROM {schema}.{table_name} WHERE {pk_columns} = ANY(ids);",
+    ]
+
+    collect = []
+    for parent, child, fk in edges:
+        if child not in key_tables:
+            continue
+
+        parent_keys_query = get_parent_keys_query(schema, parent, fk, primary_keys, key_tables)
+        collect += [
+            f"INSERT INTO {key_tables[child]} ({fk.pk_ref}) "
+            f"SELECT {qualify(fk.pk_ref, 'c')} FROM {schema}.{child} c "
+            f"WHERE ({qualify(fk.fk_ref, 'c')}) IN ({parent_keys_query}) "
+            f"ON CONFLICT DO NOTHING;",
+        ]
+        if has_cycles:
+            collect.append("GET DIAGNOSTICS affected_rows = ROW_COUNT; new_rows := new_rows + affected_rows;")
+
+    if has_cycles:
+        body += ["LOOP", "    new_rows := 0;"] + [f"    {line}" for line in collect]
+        body += ["    EXIT WHEN new_rows = 0;", "END LOOP;"]
+    else:
+        body += collect
+
+    for table in reversed(tables):
+        body += ["", f"-- {table}"]
+        if to_archive:
+            archive_table = f"{table}_{config.archiver_config.archive_suffix}"
+            column_names = ', '.join(column['column_name'] for column in get_table_columns(conn, schema, table))
+
+        if table in key_tables:
+            conditions = [f"({primary_keys[table]}) IN (SELECT {primary_keys[table]} FROM {key_tables[table]})"]
+        else:
+            conditions = [
+                f"({fk.fk_ref}) IN ({get_parent_keys_query(schema, parent, fk, primary_keys, key_tables)})"
+                for parent, child, fk in edges if child == table
+            ]
+
+        for condition in conditions:
+            if to_archive:
+                body.append(
+                    f"WITH moved AS (DELETE FROM {schema}.{table} WHERE {condition} RETURNING {column_names}) "
+                    f"INSERT INTO {schema}.{archive_table} ({column_names}) SELECT {column_names} FROM moved;"
+                )
+            else:
+                body.append(f"DELETE FROM {schema}.{table} WHERE {condition};")
+
+            body += [
+                "GET DIAGNOSTICS affected_rows = ROW_COUNT;",
+                f"deleted_rows := jsonb_set(deleted_rows, '{{{table}}}', "
+                f"to_jsonb(COALESCE((deleted_rows->>'{table}')::bigint, 0) + affected_rows));",
+            ]
+
+    function_name = get_archive_function_name(table_name)
+    return '\n'.join([
+        f"CREATE OR REPLACE FUNCTION {schema}.{function_name}(ids {ids_type}[])",
+        "RETURNS jsonb",
+        "LANGUAGE plpgsql AS $pggraph$",
+        "-- generated by pggraph, recompile after schema changes",
+        "DECLARE",
+        "    affected_rows bigint;",
+        "    new_rows bigint;",
+        "    deleted_rows jsonb := '{}';",
+        "BEGIN",
+        *[f"    {line}" if line else "" for line in body],
+        "",
+        "    RETURN deleted_rows;",
+        "END",
+        "$pggraph$;",
+    ])
+
+
+def get_topological_order(references: Dict[str, dict], table_name: str) -> Tuple[List[str], bool]:
+    """
+    Tables of %table_name% subtree, referenced tables before referring ones (Kahn's algorithm).
+    Tables in cycles (except self-references) are added after the rest in BFS order.
+
+    :return: (tables, has_cycles)
+    """
+    tables = get_subtree_tables(references, table_name)
+    in_degree = {table: 0 for table in tables}
+    has_cycles = False
+    for table in tables:
+        for ref_table in references.get(table, {}):
+            if ref_table == table:
+                has_cycles = True
+            else:
+                in_degree[ref_table] += 1
+
+    order = []
+    queue = deque(sorted(table for table, degree in in_degree.items() if degree == 0))
+    while queue:
+        table = queue.popleft()
+        order.append(table)
+        for ref_table in sorted(references.get(table, {})):
+            if ref_table == table:
+                continue
+            in_degree[ref_table] -= 1
+            if in_degree[ref_table] == 0:
+                queue.append(ref_table)
+
+    if len(order) < len(tables):
+        has_cycles = True
+        queue = deque([table_name])
+        visited = set(order)
+        while queue:
+            table = queue.popleft()
+            if table not in visited:
+                visited.add(table)
+                order.append(table)
+            queue.extend(sorted(ref_table for ref_table in references.get(table, {}) if ref_table not in visited))
+
+    return order, has_cycles
+
+
+def get_edges(references: Dict[str, dict], tables: List[str]) -> List[Tuple[str, str, ForeignKey]]:
+    """Foreign Keys between %tables% in order of %tables%: (referenced table, referring table, ForeignKey)"""
+    return [
+        (parent, child, fk)
+        for parent in tables
+        for child, ref_data in sorted(references.get(parent, {}).items())
+        for fk in ref_data['references']
+    ]
+
+
+def get_reached_tables(table_name: str, edges: List[Tuple[str, str, ForeignKey]]) -> Set[str]:
+    """%table_name% and tables reached from it by %edges%"""
+    children = {}
+    for parent, child, _ in edges:
+        children.setdefault(parent, set()).add(child)
+
+    reached_tables = {table_name}
+    stack = [table_name]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            if child not in reached_tables:
+                reached_tables.add(child)
+                stack.append(child)
+
+    return reached_tables
+
+
+def get_parent_keys_query(schema: str, parent: str, fk: ForeignKey, primary_keys: Dict[str, str],
+                          key_tables: Dict[str, str]) -> str:
+    """Values of columns, referenced by %fk%, of collected %parent% rows"""
+    if fk.pk_main == primary_keys[parent]:
+        return f"SELECT {fk.pk_main} FROM {key_tables[parent]}"
+
+    return (
+        f"SELECT {qualify(fk.pk_main, 'p')} FROM {schema}.{parent} p "
+        f"WHERE ({qualify(primary_keys[parent], 'p')}) IN (SELECT {primary_keys[parent]} FROM {key_tables[parent]})"
+    )
+
+
+def qualify(columns: str, alias: str) -> str:
+    return ', '.join(f'{alias}.{column.strip()}' for column in columns.split(','))
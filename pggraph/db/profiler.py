@@ -0,0 +1,117 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import psycopg2
+from psycopg2._psycopg import cursor
+from psycopg2.sql import SQL, Composable
+
+from pggraph.config import ProfilerConfig
+
+EXPLAIN_SAVEPOINT = 'pggraph_explain'
+
+
+class QueryProfiler:
+    """
+    Statistics of archiver statements by graph edges: (table, statement, columns) -> calls, rows, duration.
+    For statements slower than slow_query_ms plan is captured by EXPLAIN (ANALYZE, BUFFERS)
+    (at most explain_sample plans per run, one per edge)
+    """
+    config: ProfilerConfig
+    edges: Dict[Tuple[str, str, str], dict]
+    explains_count: int
+
+    def __init__(self, config: ProfilerConfig):
+        self.config = config
+        self.edges = {}
+        self.explains_count = 0
+
+    def execute(self, curs, query: Composable, params, table_name: str, statement: str, columns: str = ''):
+        start = time.monotonic()
+        curs.execute(query, params)
+        duration_ms = (time.monotonic() - start) * 1000
+
+        edge = self.record(table_name, statement, columns, duration_ms, curs.rowcount)
+        if (duration_ms >= self.config.slow_query_ms and edge['explain'] is None
+                and self.explains_count < self.config.explain_sample):
+            edge['explain'] = self.explain(curs.connection, query, params)
+            self.explains_count += 1
+
+    def record(self, table_name: str, statement: str, columns: str, duration_ms: float, rows: int) -> dict:
+        edge = self.edges.setdefault((table_name, statement, columns), {
+            'table': table_name,
+            'statement': statement,
+            'columns': columns,
+            'calls': 0,
+            'rows': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'explain': None,
+        })
+        edge['calls'] += 1
+        edge['rows'] += max(rows, 0)
+        edge['total_ms'] += duration_ms
+        edge['max_ms'] = max(edge['max_ms'], duration_ms)
+        return edge
+
+    @staticmethod
+    def explain(conn, query: Composable, params) -> str:
+        """
+        EXPLAIN (ANALYZE, BUFFERS) of the statement in current transaction, all its changes are rolled back.
+        Statement is repeated after the original one, so for DELETE plan shows the cost of searching the rows
+        (rows themselves are already deleted)
+        """
+        in_transaction = not conn.autocommit  # autocommit connection is read-only (replica), nothing to roll back
+        with conn.cursor(cursor_factory=cursor) as curs:
+            if in_transaction:
+                curs.execute(f'SAVEPOINT {EXPLAIN_SAVEPOINT}')
+            try:
+                curs.execute(SQL('EXPLAIN (ANALYZE, BUFFERS) ') + query, params)
+                return '\n'.join(row[0] for row in curs.fetchall())
+            except psycopg2.Error as error:
+                logging.warning(f'EXPLAIN failed: {str(error).strip()}')
+                return f'EXPLAIN failed: {str(error).strip()}'
+            finally:
+                if in_transaction:
+                    curs.execute(f'ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}')
+                    curs.execute(f'RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}')
+
+    def get_report(self) -> List[dict]:
+        """
+        Top edges by total duration
+
+        Result:
+        [
+            {
+                'table': 'table_b',
+                'statement': 'delete_by_fk',
+                'columns': 'table_a_id',
+                'calls': 10,
+                'rows': 10000,
+                'total_ms': 5302.1,
+                'max_ms': 1200.4,
+                'explain': 'Delete on table_b ...' (None if no statement was slower than slow_query_ms)
+            },
+            ...
+        ]
+        """
+        edges = sorted(self.edges.values(), key=lambda edge: edge['total_ms'], reverse=True)
+        return [
+            {**edge, 'total_ms': round(edge['total_ms'], 1), 'max_ms': round(edge['max_ms'], 1)}
+            for edge in edges[:self.config.top]
+        ]
+
+    def log_report(self):
+        report = self.get_report()
+        logging.info(f'PROFILE - top {len(report)} edges by duration')
+        for edge in report:
+            logging.info(
+                f"PROFILE - {edge['table']} {edge['statement']} ({edge['columns']}): {edge['calls']} calls, "
+                f"{edge['rows']} rows, total {edge['total_ms']} ms, max {edge['max_ms']} ms"
+            )
+            if edge['explain']:
+                logging.info(f"PROFILE - {edge['table']} {edge['statement']} plan:\n{edge['explain']}")
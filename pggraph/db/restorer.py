@@ -0,0 +1,196 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import logging
+from collections import defaultdict
+from typing import List, Dict
+
+import psycopg2
+from psycopg2._psycopg import connection, cursor
+from psycopg2.sql import SQL
+
+from pggraph.config import Config
+from pggraph.db.archiver import get_hierarchy_query, get_key_values
+from pggraph.db.base import get_table_columns
+from pggraph.db.plan_compiler import get_topological_order
+from pggraph.utils.classes.foreign_key import ForeignKey
+from pggraph.utils.funcs import chunks
+
+
+class Restorer:
+    """
+    Moving rows, archived by Archiver, back from "<table>_<archive_suffix>" tables.
+    Tables of the subtree are restored in forward topological order: a table is restored only after all tables
+    of the subtree it refers to, so rows referring to several restored tables (diamonds) are restored
+    when all their referenced rows are already back.
+    Each move is a separate transaction, so if some rows can't be restored (e.g. they refer to a row of another
+    table, which is still archived), the error is logged and reported in failed_tables, already restored rows
+    stay restored
+    """
+    conn: connection
+    config: Config
+    references: dict
+    restored_rows: Dict[str, int]
+    failed_tables: Dict[str, int]
+    archive_tables: Dict[str, bool]
+    table_columns: Dict[str, dict]
+
+    def __init__(self, conn: connection, references: dict, config: Config):
+        self.conn = conn
+        self.config = config
+        self.references = references
+        self.restored_rows = defaultdict(int)
+        self.failed_tables = defaultdict(int)  # moves failed with integrity error
+        self.archive_tables = {}  # archive table exists, see has_archive_table
+        self.table_columns = {}  # restored columns of tables from catalog, see get_table_columns
+
+    def get_stats(self) -> dict:
+        return {'restored_rows': dict(self.restored_rows), 'failed_tables': dict(self.failed_tables)}
+
+    def restore_root(self, table_name: str, rows: List[tuple], pk_cols: str = 'id'):
+        """
+        Restore chunk of root table rows (tuples of %pk_cols% values) with all archived referring rows.
+        Keys of restored rows are kept per table only for the chunk, to find rows of tables referring to them
+        """
+        if not self.has_archive_table(table_name):
+            raise KeyError(f'Archive table for {table_name} not found')
+
+        tables, _ = get_topological_order(self.references, table_name)
+        tables = [table for table in tables if table == table_name or self.has_archive_table(table)]
+        key_columns = {table: self.get_key_columns(table, tables, pk_cols if table == table_name else None)
+                       for table in tables}
+
+        condition = f"({pk_cols}) IN ({', '.join('%s' for _ in rows)})"
+        restored = {table_name: self.move_rows(table_name, condition, rows, returning=key_columns[table_name])}
+
+        for table in tables:
+            restored_rows = restored.setdefault(table, [])
+            if table != table_name:
+                for parent in tables:
+                    if parent == table or table not in self.references[parent]:
+                        continue
+                    for fk in self.references[parent][table]['references']:
+                        restored_rows += self.restore_by_fk(
+                            table, fk, get_key_values(restored.get(parent, []), key_columns[parent], fk.pk_main),
+                            returning=key_columns[table],
+                        )
+
+            if table in self.references[table] and restored_rows:
+                restored_rows += self.restore_hierarchy(
+                    table, self.references[table][table]['references'], restored_rows, key_columns[table]
+                )
+
+    def get_key_columns(self, table_name: str, tables: List[str], pk_cols: str = None) -> str:
+        """
+        Columns of restored rows of %table_name%, needed to find referring rows in %tables%
+        (referenced columns of Foreign Keys and Primary Key for hierarchy, %pk_cols% first if set)
+        """
+        columns = [column.strip() for column in pk_cols.split(',')] if pk_cols else []
+        for ref_table, ref_data in self.references[table_name].items():
+            if ref_table not in tables:
+                continue
+
+            fks = ref_data['references']
+            if ref_table == table_name:
+                columns += [column.strip() for fk in fks for column in fk.pk_ref.split(',')]
+            columns += [column.strip() for fk in fks for column in fk.pk_main.split(',')]
+
+        return ', '.join(dict.fromkeys(columns))
+
+    def restore_by_fk(self, table_name: str, fk: ForeignKey, fk_rows: List[tuple], returning: str) -> List[tuple]:
+        """Restore archived rows of %table_name%, referring to restored rows by %fk%"""
+        fk_rows = list(dict.fromkeys(row for row in fk_rows if None not in row))
+        restored_rows = []
+        for fk_rows_chunk in chunks(fk_rows, self.config.archiver_config.chunk_size):
+            logging.info(f'{table_name} - restore_by_fk {len(fk_rows_chunk)} rows by {fk}')
+            condition = f"({fk.fk_ref}) IN ({', '.join('%s' for _ in fk_rows_chunk)})"
+            restored_rows += self.move_rows(table_name, condition, fk_rows_chunk, returning=returning)
+
+        return restored_rows
+
+    def restore_hierarchy(self, table_name: str, fks: List[ForeignKey], rows: List[tuple],
+                          columns: str) -> List[tuple]:
+        """
+        Restore all archived descendants of restored %rows% in self-referencing table by one statement
+        (Foreign Keys are checked at the end of the statement, so order of rows doesn't matter)
+        """
+        pk_cols = fks[0].pk_ref
+        archive_table = f"{self.config.db_config.schema}.{self.get_archive_table_name(table_name)}"
+        restored_rows = []
+        for rows_chunk in chunks(get_key_values(rows, columns, pk_cols), self.config.archiver_config.chunk_size):
+            logging.info(f'{table_name} - restore_hierarchy of {len(rows_chunk)} rows by {[fk.fk_name for fk in fks]}')
+            hierarchy_query, row_ids = get_hierarchy_query(archive_table, fks, rows_chunk, pk_cols)
+            condition = f"({pk_cols}) IN (SELECT {pk_cols} FROM hierarchy)"
+            restored_rows += self.move_rows(
+                table_name, condition, row_ids, returning=columns, with_query=hierarchy_query
+            )
+
+        return restored_rows
+
+    def move_rows(self, table_name: str, condition: str, params: list, returning: str = None,
+                  with_query: str = '') -> List[tuple]:
+        """
+        Move rows matching %condition% from archive table back to %table_name% in one transaction.
+        Generated columns are computed again, values of identity columns are kept (OVERRIDING SYSTEM VALUE).
+        Returns %returning% columns values of restored rows (empty list if %returning% isn't set or rows can't
+        be restored because of integrity error)
+        """
+        schema = self.config.db_config.schema
+        table_columns = self.get_table_columns(table_name)
+        column_names, overriding = table_columns['column_names'], table_columns['overriding']
+
+        moved = (
+            f"moved AS (DELETE FROM {schema}.{self.get_archive_table_name(table_name)} "
+            f"WHERE {condition} RETURNING {column_names})"
+        )
+        query = SQL(
+            f"{f'{with_query}, ' if with_query else 'WITH '}{moved} "
+            f"INSERT INTO {schema}.{table_name} ({column_names}){overriding} SELECT {column_names} FROM moved"
+            f"{f' RETURNING {returning}' if returning else ''}"
+        )
+
+        try:
+            with self.conn:  # транзакция
+                with self.conn.cursor(cursor_factory=cursor) as curs:
+                    logging.debug(f"INSERT INTO {table_name} FROM archive - {len(params)} keys")
+                    curs.execute(query, params)
+                    if curs.rowcount > 0:
+                        self.restored_rows[table_name] += curs.rowcount
+                    return curs.fetchall() if returning else []
+        except psycopg2.IntegrityError as error:
+            logging.warning(f'{table_name} - rows can\'t be restored: {str(error).strip()}')
+            self.failed_tables[table_name] += 1
+            return []
+
+    def get_table_columns(self, table_name: str) -> dict:
+        """
+        Restored columns of the table (without generated ones) and OVERRIDING clause for identity columns,
+        cached for the run
+        Result: {'column_names': 'id, name', 'overriding': ' OVERRIDING SYSTEM VALUE'}
+        """
+        if table_name not in self.table_columns:
+            columns = [
+                column for column in get_table_columns(self.conn, self.config.db_config.schema, table_name)
+                if not column['generated']
+            ]
+            self.table_columns[table_name] = {
+                'column_names': ', '.join(column['column_name'] for column in columns),
+                'overriding': (
+                    ' OVERRIDING SYSTEM VALUE' if any(column['identity'] == 'a' for column in columns) else ''
+                ),
+            }
+
+        return self.table_columns[table_name]
+
+    def get_archive_table_name(self, table_name: str) -> str:
+        return f"{table_name}_{self.config.archiver_config.archive_suffix}"
+
+    def has_archive_table(self, table_name: str) -> bool:
+        if table_name not in self.archive_tables:
+            archive_table = f"{self.config.db_config.schema}.{self.get_archive_table_name(table_name)}"
+            with self.conn.cursor(cursor_factory=cursor) as curs:
+                curs.execute('SELECT to_regclass(%s) IS NOT NULL', (archive_table, ))
+                self.archive_tables[table_name] = curs.fetchone()[0]
+
+        return self.archive_tables[table_name]
@@ -3,23 +3,73 @@ Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Lice
 Please, see the LICENSE.md file in project's root for full licensing information.
 """
 from argparse import ArgumentParser, Namespace
+from dataclasses import asdict
+import json
 import logging
 from logging import handlers
 import os
 from pprint import pprint
+import sys
 
 from pggraph.api import PgGraphApi
+from pggraph.server import serve, json_default
 from pggraph.utils.action_enum import ActionEnum
 
+TABLE_OPTIONAL_ACTIONS = {
+    ActionEnum.get_missing_fk_indexes, ActionEnum.serve, ActionEnum.get_cycles, ActionEnum.get_graph_profile
+}
+
 
 def main():
     args = parse_args()
     setup_logging(args.log_level, args.log_path)
 
     pg_graph_api = PgGraphApi(config_path=args.config_path)
+    if args.action == ActionEnum.serve:
+        serve(pg_graph_api)
+        return
+
+    if args.output == 'ndjson':
+        write_ndjson(pg_graph_api, args)
+        return
+
     result = pg_graph_api.run_action(args)
 
-    pprint(result)
+    if args.action == ActionEnum.compile_archive_plan:
+        print(result)
+    else:
+        pprint(result)
+
+
+def write_ndjson(pg_graph_api: PgGraphApi, args: Namespace):
+    """
+    Write result to stdout as JSON records, one per line, as they are produced:
+     - get_rows_references - one record per reference, streamed from DB (see PgGraphApi.iter_rows_references)
+       {"type": "reference", "id": 1, "table": "table_b", "fk": "table_a_id", "row_key": {"id": 4}}
+     - archive_table - progress record after each chunk and final stats record
+       {"type": "progress", "deleted_rows": {"table_a": 1000, ...}}
+       {"type": "stats", "deleted_rows": {...}, "skipped_rows": {...}, "blocked_rows": {...}}
+     - other actions - one record with the result
+    """
+    if args.action == ActionEnum.get_rows_references:
+        for row_reference in pg_graph_api.iter_rows_references(args.table, ids=args.ids):
+            write_record({'type': 'reference', **asdict(row_reference)}, flush=False)
+        sys.stdout.flush()
+    elif args.action == ActionEnum.archive_table:
+        stats = pg_graph_api.archive_table(
+            args.table, ids=args.ids, where=args.where, on_chunk=lambda deleted_rows: write_record(
+                {'type': 'progress', 'deleted_rows': deleted_rows}
+            )
+        )
+        write_record({'type': 'stats', **stats})
+    else:
+        write_record(pg_graph_api.run_action(args))
+
+
+def write_record(record, flush: bool = True):
+    sys.stdout.write(json.dumps(record, default=json_default, ensure_ascii=False) + '\n')
+    if flush:
+        sys.stdout.flush()
 
 
 def setup_logging(log_level: str = 'INFO', log_path: str = None):
@@ -50,8 +100,7 @@ def parse_args() -> Namespace:
         "--table",
         type=str,
         default=None,
-        help="table name",
-        required=True,
+        help="table name (optional for get_missing_fk_indexes, get_cycles, get_graph_profile and serve)",
     )
     parser.add_argument(
         "--ids",
@@ -59,6 +108,32 @@ def parse_args() -> Namespace:
         default=None,
         help="primary key ids, separated by comma, e.g. 1,2,3",
     )
+    parser.add_argument(
+        "--where",
+        type=str,
+        default=None,
+        help="archive_table: SQL predicate on the table instead of ids, e.g. \"created_at < '2020-01-01'\"",
+    )
+    parser.add_argument(
+        "--direction",
+        type=str,
+        default='in',
+        choices=['in', 'out'],
+        help="get_reachable_tables direction: in - referring tables, out - referenced tables",
+    )
+    parser.add_argument(
+        "--max_depth",
+        type=int,
+        default=None,
+        help="get_reachable_tables max depth",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default='pprint',
+        choices=['pprint', 'ndjson'],
+        help="output format: pprint - whole result, ndjson - JSON records streamed line by line",
+    )
     parser.add_argument(
         "--config_path",
         type=str,
@@ -80,8 +155,12 @@ def parse_args() -> Namespace:
     args = parser.parse_args()
 
     args.action = ActionEnum[args.action]
+    if not args.table and args.action not in TABLE_OPTIONAL_ACTIONS:
+        parser.error(f'--table is required for {args.action.value}')
     if args.ids:
         args.ids = [int(id_) for id_ in str(args.ids).split(',')]
+    if args.action == ActionEnum.archive_table and (args.ids is None) == (args.where is None):
+        parser.error('--ids or --where is required for archive_table')
     if args.log_level:
         args.log_level = str(args.log_level).upper()
 
@@ -0,0 +1,275 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import json
+import logging
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict, is_dataclass
+from datetime import datetime
+from http import HTTPStatus
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import List, Optional
+from urllib.parse import urlparse, parse_qs
+
+from pggraph.api import PgGraphApi
+from pggraph.config import ServerConfig
+
+
+class JobStatus:
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+
+
+@dataclass
+class ArchiveJob:
+    id: str
+    table: str
+    ids: List[int]
+    status: str = JobStatus.queued
+    result: object = None
+    error: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.now)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'table': self.table,
+            'ids_count': len(self.ids),
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobManager:
+    """
+    Queue of archive jobs, executed in background by bounded pool of worker threads.
+    Each job uses its own DB connection (see PgGraphApi.archive_table).
+    Graph is refreshed before each job (see PgGraphApi.refresh), so jobs see tables changed by migrations
+    """
+    api: PgGraphApi
+    config: ServerConfig
+    jobs: "OrderedDict[str, ArchiveJob]"
+
+    def __init__(self, api: PgGraphApi, config: ServerConfig):
+        self.api = api
+        self.config = config
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=config.workers, thread_name_prefix='pggraph-job')
+
+    def submit(self, table_name: str, ids: List[int]) -> ArchiveJob:
+        if table_name not in self.api.references:
+            raise KeyError(f'Table {table_name} not found')
+
+        with self.lock:
+            active_jobs = sum(1 for job in self.jobs.values() if job.status in (JobStatus.queued, JobStatus.running))
+            if active_jobs >= self.config.max_queued_jobs:
+                raise QueueFullError(f'Too many active jobs ({active_jobs})')
+
+            job = ArchiveJob(id=uuid.uuid4().hex, table=table_name, ids=ids)
+            self.jobs[job.id] = job
+            self.prune_history()
+
+        self.executor.submit(self.run_job, job)
+        logging.info(f'Job {job.id} - {table_name} archiving queued, {len(ids)} rows')
+        return job
+
+    def run_job(self, job: ArchiveJob):
+        job.status = JobStatus.running
+        job.started_at = datetime.now()
+        try:
+            with self.refresh_lock:
+                # running jobs keep the graph they started with
+                changed_tables = self.api.refresh(in_place=False)
+            if changed_tables:
+                logging.info(f'Job {job.id} - graph refreshed, changed tables: {changed_tables}')
+
+            job.result = self.api.archive_table(job.table, ids=job.ids)
+            job.status = JobStatus.done
+        except Exception as error:
+            logging.exception(f'Job {job.id} - failed')
+            job.error = f'{error.__class__.__name__}: {error}'
+            job.status = JobStatus.failed
+        finally:
+            job.finished_at = datetime.now()
+
+    def get(self, job_id: str) -> ArchiveJob:
+        job = self.jobs.get(job_id)
+        if not job:
+            raise KeyError(f'Job {job_id} not found')
+
+        return job
+
+    def prune_history(self):
+        finished_jobs = [
+            job_id for job_id, job in self.jobs.items() if job.status in (JobStatus.done, JobStatus.failed)
+        ]
+        for job_id in finished_jobs[:max(len(finished_jobs) - self.config.jobs_history, 0)]:
+            del self.jobs[job_id]
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+class PgGraphServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server, which keeps tables dependency graph in memory
+
+    Endpoints:
+        GET  /tables/<table>/references                 - get_table_references
+        GET  /tables/<table>/rows_references?ids=1,2,3  - get_rows_references
+        POST /tables/<table>/archive {"ids": [1, 2, 3]} - queue archive_table job
+        GET  /jobs                                      - list of jobs
+        GET  /jobs/<job_id>                             - job status and result
+    """
+    daemon_threads = True
+
+    def __init__(self, api: PgGraphApi):
+        self.api = api
+        self.job_manager = JobManager(api, api.config.server_config)
+        server_config = api.config.server_config
+        super().__init__((server_config.host, server_config.port), PgGraphRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.job_manager.shutdown()
+
+
+class PgGraphRequestHandler(BaseHTTPRequestHandler):
+    server: PgGraphServer
+
+    routes = [
+        ('GET', re.compile(r'^/tables/(?P<table>\w+)/references$'), 'get_table_references'),
+        ('GET', re.compile(r'^/tables/(?P<table>\w+)/rows_references$'), 'get_rows_references'),
+        ('POST', re.compile(r'^/tables/(?P<table>\w+)/archive$'), 'archive_table'),
+        ('GET', re.compile(r'^/jobs$'), 'get_jobs'),
+        ('GET', re.compile(r'^/jobs/(?P<job_id>\w+)$'), 'get_job'),
+    ]
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method: str):
+        url = urlparse(self.path)
+        for route_method, pattern, handler_name in self.routes:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send_json(HTTPStatus.NOT_FOUND, {'error': f'Unknown path {url.path}'})
+
+        try:
+            status, result = getattr(self, handler_name)(query=parse_qs(url.query), **match.groupdict())
+        except KeyError as error:
+            status, result = HTTPStatus.NOT_FOUND, {'error': str(error).strip("'")}
+        except ValueError as error:
+            status, result = HTTPStatus.BAD_REQUEST, {'error': str(error)}
+        except QueueFullError as error:
+            status, result = HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(error)}
+        except Exception as error:
+            logging.exception(f'{method} {self.path} - failed')
+            status, result = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{error.__class__.__name__}: {error}'}
+
+        self.send_json(status, result)
+
+    def get_table_references(self, table: str, query: dict):
+        return HTTPStatus.OK, self.server.api.get_table_references(table)
+
+    def get_rows_references(self, table: str, query: dict):
+        ids = parse_ids(query.get('ids', [''])[0].split(','))
+        return HTTPStatus.OK, self.server.api.get_rows_references(table, ids=ids)
+
+    def archive_table(self, table: str, query: dict):
+        body = self.read_json()
+        ids = parse_ids(body.get('ids') or [])
+        job = self.server.job_manager.submit(table, ids)
+        return HTTPStatus.ACCEPTED, job.as_dict()
+
+    def get_jobs(self, query: dict):
+        with self.server.job_manager.lock:
+            jobs = list(self.server.job_manager.jobs.values())
+
+        return HTTPStatus.OK, [job.as_dict() for job in jobs]
+
+    def get_job(self, job_id: str, query: dict):
+        return HTTPStatus.OK, self.server.job_manager.get(job_id).as_dict()
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+
+        try:
+            body = json.loads(self.rfile.read(length))
+        except json.JSONDecodeError as error:
+            raise ValueError(f'Incorrect JSON body: {error}')
+
+        if not isinstance(body, dict):
+            raise ValueError('JSON body should be an object')
+
+        return body
+
+    def send_json(self, status: HTTPStatus, data):
+        body = json.dumps(data, default=json_default, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_: str, *args):
+        logging.info(f'{self.address_string()} - {format_ % args}')
+
+
+def parse_ids(ids: list) -> List[int]:
+    if not isinstance(ids, list):
+        raise ValueError('ids should be a list of integers')
+
+    try:
+        return [int(id_) for id_ in ids if str(id_).strip()]
+    except (TypeError, ValueError):
+        raise ValueError('ids should be a list of integers')
+
+
+def json_default(value):
+    if is_dataclass(value):
+        return asdict(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return str(value)
+
+
+def serve(api: PgGraphApi):
+    server = PgGraphServer(api)
+    host, port = server.server_address[:2]
+    logging.info(f'pggraph server started on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info('pggraph server stopped')
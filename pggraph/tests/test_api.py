@@ -2,11 +2,20 @@
 Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
 Please, see the LICENSE.md file in project's root for full licensing information.
 """
+import threading
+import tracemalloc
 from unittest.mock import ANY
 
+import pytest
+
 from pggraph.api import PgGraphApi
-from pggraph.db.base import get_db_conn
+from pggraph.config import Config
+from pggraph.db import parallel
+from pggraph.db.archiver import Archiver
+from pggraph.db.base import get_db_conn, get_replica_conn, get_replica_lag
+from pggraph.db.maintenance import MaintenanceScheduler
 from pggraph.utils.classes.foreign_key import ForeignKey
+from pggraph.utils.classes.row_reference import RowReference
 
 
 def test_get_table_references():
@@ -30,6 +39,33 @@ def test_get_table_references():
     }
 
 
+def test_refresh():
+    api = PgGraphApi(config_path='config.test.ini')
+    assert api.refresh() == []
+
+    conn = get_db_conn(api.config)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('CREATE TABLE book_note (id serial PRIMARY KEY, book_id integer REFERENCES book (id));')
+        assert api.refresh() == ['book', 'book_note']
+        assert api.primary_keys['book_note'] == 'id'
+        assert api.get_table_references('book')['in_refs'] == {
+            'author_book': [ForeignKey(pk_main='id', pk_ref='author_id, book_id', fk_ref='book_id', fk_name=ANY)],
+            'book_note': [ForeignKey(pk_main='id', pk_ref='id', fk_ref='book_id', fk_name=ANY)],
+        }
+        assert 'book_note' in api.references['publisher']['book']['ref_tables']
+
+        with conn.cursor() as cursor:
+            cursor.execute('DROP TABLE book_note;')
+        assert api.refresh() == ['book', 'book_note']
+        assert 'book_note' not in api.references
+        assert 'book_note' not in api.references['publisher']['book']['ref_tables']
+        assert api.refresh() == []
+    finally:
+        conn.close()
+
+
 def test_get_rows_references():
     api = PgGraphApi(config_path='config.test.ini')
 
@@ -46,6 +82,36 @@ def test_get_rows_references():
     }
 
 
+def test_iter_rows_references():
+    api = PgGraphApi(config_path='config.test.ini')
+
+    publisher_refs = sorted(api.iter_rows_references('publisher', [1, 2, 2, 100]), key=lambda ref: ref.row_key['id'])
+    assert publisher_refs == [
+        RowReference(id=1, table='book', fk='publisher_id', row_key={'id': 1}),
+        RowReference(id=1, table='book', fk='publisher_id', row_key={'id': 2}),
+        RowReference(id=2, table='book', fk='publisher_id', row_key={'id': 3}),
+    ]
+
+    author_refs = list(api.iter_rows_references('author', [7]))
+    assert sorted(ref.row_key['book_id'] for ref in author_refs) == [4, 5]
+    assert {(ref.id, ref.table, ref.fk) for ref in author_refs} == {(7, 'author_book', 'author_id')}
+
+
+def test_get_missing_fk_indexes():
+    api = PgGraphApi(config_path='config.test.ini')
+
+    missing_indexes = api.get_missing_fk_indexes('publisher')
+    assert sorted((row['table'], row['columns'], row['create_index']) for row in missing_indexes) == [
+        ('author_book', 'book_id',
+         'CREATE INDEX CONCURRENTLY IF NOT EXISTS author_book_book_id_idx ON public.author_book (book_id);'),
+        ('book', 'publisher_id',
+         'CREATE INDEX CONCURRENTLY IF NOT EXISTS book_publisher_id_idx ON public.book (publisher_id);'),
+    ]
+
+    # author_id is covered by author_book primary key (author_id, book_id)
+    assert api.get_missing_fk_indexes('author') == []
+
+
 def test_archive_table():
     api = PgGraphApi(config_path='config.test.ini')
 
@@ -83,3 +149,587 @@ def test_archive_table():
 
     assert pub_rows == [{'id': 3}]
     assert pub_archive_rows == [{'id': 1}, {'id': 2}]
+
+
+def test_archive_tables(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    # books 1, 2 are archived with publisher 1 and skipped as roots
+    result = api.archive_tables({'publisher': [1], 'book': [1, 2, 3]})
+    assert result == {
+        'deleted_rows': {'author_book': 6, 'book': 3, 'publisher': 1},
+        'skipped_rows': {'book': 2},
+        'blocked_rows': {},
+    }
+
+    result = api.archive_tables({'author': [7], 'book': [4, 5]})
+    assert result['deleted_rows'] == {'author_book': 2, 'author': 1, 'book': 2}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT author_id, book_id FROM author_book;')
+        ab_rows = cursor.fetchall()
+
+        cursor.execute('SELECT id FROM book ORDER BY id;')
+        book_rows = [row['id'] for row in cursor.fetchall()]
+    conn.close()
+
+    assert ab_rows == []
+    assert book_rows == []
+
+
+def test_archive_table_lock_timeout(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.archiver_config.lock_timeout = 100
+
+    locking_conn = get_db_conn(api.config)
+    try:
+        with locking_conn.cursor() as cursor:
+            cursor.execute('SELECT * FROM author_book WHERE author_id = 7 AND book_id = 4 FOR UPDATE;')
+
+        result = api.archive_table('author', [6, 7])
+    finally:
+        locking_conn.rollback()
+        locking_conn.close()
+
+    # chunk is deferred, on retry author 6 is archived, author 7 is still locked
+    assert result == {
+        'deleted_rows': {'author_book': 1, 'author': 1},
+        'skipped_rows': {},
+        'blocked_rows': {'author': [7]},
+    }
+
+    result = api.archive_table('author', [7])
+    assert result['deleted_rows'] == {'author_book': 2, 'author': 1}
+
+
+def test_archive_table_hierarchy(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    # hierarchy is deeper than max_depth (20), descendants are archived by one recursive query
+    result = api.archive_table('employee', [2])
+    assert result['deleted_rows'] == {'employee': 24}
+
+    result = api.archive_table('employee', [1])
+    assert result['deleted_rows'] == {'employee': 2}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id FROM employee;')
+        employee_rows = [row['id'] for row in cursor.fetchall()]
+
+        cursor.execute('SELECT id FROM employee_archive ORDER BY id;')
+        employee_archive_rows = [row['id'] for row in cursor.fetchall()]
+    conn.close()
+
+    assert employee_rows == [27]
+    assert employee_archive_rows == list(range(1, 27))
+
+
+def test_archive_table_json_columns(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    conn = get_db_conn(api.config)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            ALTER TABLE author ADD COLUMN note text;
+            ALTER TABLE author ADD COLUMN meta jsonb;
+            ALTER TABLE author ADD COLUMN tags json;
+            ALTER TABLE author DROP COLUMN note;
+            UPDATE author SET meta = '{"country": "UK"}', tags = '"fantasy"' WHERE id = 7;
+        """)
+
+    result = api.archive_table('author', [7])
+    assert result['deleted_rows'] == {'author_book': 2, 'author': 1}
+
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id, fio, meta, tags FROM author_archive;')
+        author_archive_rows = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    assert author_archive_rows == [{'id': 7, 'fio': 'J.K. Rowling', 'meta': {'country': 'UK'}, 'tags': 'fantasy'}]
+
+
+def test_archive_table_profiler(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.profiler_config.enabled = True
+    api.config.profiler_config.slow_query_ms = 0
+    api.config.profiler_config.explain_sample = 2
+
+    result = api.archive_table('publisher', [1])
+    assert result['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+    profile = {(edge['table'], edge['statement'], edge['columns']): edge for edge in result['profile']}
+    assert profile[('author_book', 'delete_by_fk', 'book_id')]['rows'] == 4
+    assert profile[('book', 'delete_by_ids', 'id')]['rows'] == 2
+    assert profile[('publisher', 'delete_by_ids', 'id')]['calls'] == 1
+
+    explains = [edge['explain'] for edge in result['profile'] if edge['explain']]
+    assert len(explains) == 2
+    assert all('Buffers' in explain or 'actual time' in explain for explain in explains)
+
+
+def test_archive_table_by_plan(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    plan = api.compile_archive_plan('publisher')
+    assert plan.startswith('CREATE OR REPLACE FUNCTION public.pggraph_archive_publisher(ids integer[])')
+
+    # debug mode: function is only compiled, rows aren't deleted
+    api.config.archiver_config.is_debug = True
+    assert api.archive_table_by_plan('publisher', [1]) == {'deleted_rows': {}}
+    api.config.archiver_config.is_debug = False
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regproc('public.pggraph_archive_publisher') IS NULL AS missing;")
+        assert cursor.fetchone()['missing']
+
+        cursor.execute('SELECT count(*) FROM book WHERE publisher_id = 1;')
+        assert cursor.fetchone()[0] == 2
+    conn.close()
+
+    result = api.archive_table_by_plan('publisher', [1])
+    assert result['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+    # self-reference is collected on the server until no new rows are found
+    result = api.archive_table_by_plan('employee', [2])
+    assert result['deleted_rows'] == {'employee': 24}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id FROM book_archive ORDER BY id;')
+        book_archive_rows = [row['id'] for row in cursor.fetchall()]
+
+        cursor.execute('SELECT count(*) FROM employee_archive;')
+        employee_archive_count = cursor.fetchone()[0]
+    conn.close()
+
+    assert book_archive_rows == [1, 2]
+    assert employee_archive_count == 24
+
+
+def test_archive_table_by_plan_modes(clean_db):
+    conn = get_db_conn(Config('config.test.ini'))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE book_review (id serial PRIMARY KEY, book_id integer REFERENCES book (id) ON DELETE CASCADE);
+            INSERT INTO book_review (book_id) VALUES (1), (4), (5);
+        """)
+
+    try:
+        api = PgGraphApi(config_path='config.test.ini')
+
+        # archive tables are provisioned by pggraph, not by the function
+        api.config.archiver_config.partition_by_month = True
+        result = api.archive_table_by_plan('publisher', [1])
+        assert result['deleted_rows'] == {'author_book': 4, 'book_review': 1, 'book': 2, 'publisher': 1}
+
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE relname = 'book_archive';")
+            assert cursor.fetchone()['relkind'] == 'p'
+
+        # delete-only mode: book_review is left to ON DELETE CASCADE
+        api.config.archiver_config.to_archive = False
+        assert 'book_review' not in api.compile_archive_plan('publisher')
+
+        result = api.archive_table_by_plan('publisher', [3])
+        assert result['deleted_rows'] == {'author_book': 2, 'book': 2, 'publisher': 1}
+
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM book_review;')
+            assert cursor.fetchone()[0] == 0
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS book_review, book_review_archive;')
+        conn.close()
+
+
+def test_restore_table(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    api.archive_table('publisher', [1])
+    api.archive_table('employee', [1])
+
+    result = api.restore_table('publisher', [1])
+    assert result['restored_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+    # hierarchy deeper than max_depth is restored by one statement
+    result = api.restore_table('employee', [1])
+    assert result['restored_rows'] == {'employee': 26}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM author_book;')
+        author_book_count = cursor.fetchone()[0]
+
+        cursor.execute('SELECT count(*) FROM book_archive;')
+        book_archive_count = cursor.fetchone()[0]
+
+        cursor.execute('SELECT count(*) FROM employee;')
+        employee_count = cursor.fetchone()[0]
+    conn.close()
+
+    assert author_book_count == 8
+    assert book_archive_count == 0
+    assert employee_count == 27
+
+
+def test_restore_table_diamond(clean_db):
+    conn = get_db_conn(Config('config.test.ini'))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE shelf (id serial PRIMARY KEY);
+            CREATE TABLE shelf_row (id serial PRIMARY KEY, shelf_id integer REFERENCES shelf (id));
+            CREATE TABLE shelf_column (id serial PRIMARY KEY, shelf_id integer REFERENCES shelf (id));
+            CREATE TABLE shelf_cell (
+                id serial PRIMARY KEY,
+                row_id integer REFERENCES shelf_row (id),
+                column_id integer REFERENCES shelf_column (id)
+            );
+            INSERT INTO shelf VALUES (1), (2);
+            INSERT INTO shelf_row (shelf_id) VALUES (1), (2);
+            INSERT INTO shelf_column (shelf_id) VALUES (1), (1);
+            INSERT INTO shelf_cell (row_id, column_id) VALUES (1, 1), (1, 2), (2, 2);
+        """)
+
+    try:
+        api = PgGraphApi(config_path='config.test.ini')
+        api.archive_table('shelf', [1, 2])
+
+        # shelf_cell refers to both shelf_row and shelf_column, it's restored after both of them
+        result = api.restore_table('shelf', [1])
+        assert result['restored_rows'] == {'shelf': 1, 'shelf_row': 1, 'shelf_column': 2, 'shelf_cell': 2}
+        # cell 3 refers to restored column 2 and archived row 2, it stays in archive
+        assert result['failed_tables'] == {'shelf_cell': 1}
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT id FROM shelf_cell_archive;')
+            assert [row['id'] for row in cursor.fetchall()] == [3]
+
+        result = api.restore_table('shelf', [2])
+        assert result == {'restored_rows': {'shelf': 1, 'shelf_row': 1, 'shelf_cell': 1}, 'failed_tables': {}}
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                DROP TABLE IF EXISTS shelf_cell, shelf_row, shelf_column, shelf,
+                    shelf_cell_archive, shelf_row_archive, shelf_column_archive, shelf_archive;
+            """)
+        conn.close()
+
+
+def test_restore_table_identity_columns(clean_db):
+    conn = get_db_conn(Config('config.test.ini'))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE warehouse (
+                id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                name text,
+                name_length integer GENERATED ALWAYS AS (length(name)) STORED
+            );
+            CREATE TABLE warehouse_item (
+                id integer GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                warehouse_id integer REFERENCES warehouse (id)
+            );
+            INSERT INTO warehouse (name) VALUES ('north'), ('south');
+            INSERT INTO warehouse_item (warehouse_id) VALUES (1), (1), (2);
+        """)
+
+    try:
+        api = PgGraphApi(config_path='config.test.ini')
+        api.archive_table('warehouse', [1])
+
+        result = api.restore_table('warehouse', [1])
+        assert result['restored_rows'] == {'warehouse': 1, 'warehouse_item': 2}
+
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT id, name, name_length FROM warehouse ORDER BY id;')
+            assert [tuple(row) for row in cursor.fetchall()] == [(1, 'north', 5), (2, 'south', 5)]
+
+            cursor.execute('SELECT id, warehouse_id FROM warehouse_item ORDER BY id;')
+            assert [tuple(row) for row in cursor.fetchall()] == [(1, 1), (2, 1), (3, 2)]
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                DROP TABLE IF EXISTS warehouse_item, warehouse, warehouse_item_archive, warehouse_archive;
+            """)
+        conn.close()
+
+
+def test_get_reachable_tables():
+    api = PgGraphApi(config_path='config.test.ini')
+
+    assert api.get_reachable_tables('publisher') == {'book': 1, 'author_book': 2}
+    assert api.get_reachable_tables('publisher', max_depth=1) == {'book': 1}
+    assert api.get_reachable_tables('author_book', direction='out') == {'author': 1, 'book': 1, 'publisher': 2}
+    assert api.get_reachable_tables('employee') == {}
+
+    assert api.get_cycles() == [['employee']]
+
+
+def test_archive_tables_parallel(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.archiver_config.workers = 2
+    api.config.archiver_config.chunk_size = 1
+
+    # book 4 and 5 share author 7, author_book rows are archived from both parents
+    result = api.archive_tables({'book': [1, 2, 3, 4, 5], 'author': [7]})
+    assert result['deleted_rows'] == {'author_book': 8, 'book': 5, 'author': 1}
+    assert result['blocked_rows'] == {}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM author_book_archive;')
+        author_book_archive_count = cursor.fetchone()[0]
+    conn.close()
+
+    assert author_book_archive_count == 8
+
+    # connections of the worker are closed by its exit finalizer
+    parallel.init_worker(api.config, api.references)
+    worker_conn = parallel._archiver.conn
+    parallel.close_worker()
+    assert worker_conn.closed
+
+
+def test_archive_table_maintenance(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.maintenance_config.enabled = True
+    api.config.maintenance_config.mode = 'batches'
+    api.config.maintenance_config.threshold_rows = 2
+    api.config.archiver_config.chunk_size = 1
+
+    result = api.archive_table('publisher', [1, 2])
+    assert result['deleted_rows'] == {'author_book': 6, 'book': 3, 'publisher': 2}
+
+    # publisher is maintained once, after the second chunk (threshold isn't reached after the first one)
+    assert result['maintained_tables']['publisher'] == 1
+    assert result['maintained_tables']['author_book'] >= 1
+    assert result['maintained_tables']['book'] >= 1
+
+
+def test_maintenance_finish(clean_db):
+    config = Config('config.test.ini')
+    config.maintenance_config.threshold_rows = 2
+    scheduler = MaintenanceScheduler(config)
+
+    locking_conn = get_db_conn(config)
+    try:
+        with locking_conn.cursor() as cursor:
+            cursor.execute('LOCK TABLE book IN SHARE UPDATE EXCLUSIVE MODE;')
+
+        scheduler.track({'book': 2})
+        scheduler.run_due()
+        # rows deleted while VACUUM waits for the lock, they are maintained again at the end
+        scheduler.track({'book': 4})
+        threading.Timer(0.3, locking_conn.rollback).start()
+
+        assert scheduler.finish() == {'book': 2}
+    finally:
+        locking_conn.close()
+
+
+def test_archive_table_commit_modes(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.archiver_config.commit_mode = 'count'
+    api.config.archiver_config.commit_every = 2
+
+    result = api.archive_table('publisher', [1])
+    assert result['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+    # locked edge is rolled back to its savepoint, chunk is deferred as with own transaction for each edge
+    api.config.archiver_config.commit_mode = 'chunk'
+    api.config.archiver_config.lock_timeout = 100
+
+    locking_conn = get_db_conn(api.config)
+    try:
+        with locking_conn.cursor() as cursor:
+            cursor.execute('SELECT * FROM author_book WHERE author_id = 7 AND book_id = 4 FOR UPDATE;')
+
+        result = api.archive_table('author', [6, 7])
+    finally:
+        locking_conn.rollback()
+        locking_conn.close()
+
+    assert result['deleted_rows'] == {'author_book': 1, 'author': 1}
+    assert result['blocked_rows'] == {'author': [7]}
+
+    # unexpected error: pending group isn't committed
+    api.config.archiver_config.commit_mode = 'count'
+    api.config.archiver_config.commit_every = 100
+    api.config.archiver_config.chunk_size = 1
+
+    def fail_on_chunk(deleted_rows):
+        raise RuntimeError('stop')
+
+    with pytest.raises(RuntimeError):
+        api.archive_table('publisher', [2, 3], on_chunk=fail_on_chunk)
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id FROM publisher_archive ORDER BY id;')
+        pub_archive_rows = [row['id'] for row in cursor.fetchall()]
+
+        cursor.execute('SELECT id FROM author WHERE id IN (6, 7) ORDER BY id;')
+        author_rows = [row['id'] for row in cursor.fetchall()]
+    conn.close()
+
+    assert pub_archive_rows == [1]
+    assert author_rows == [7]
+
+
+def test_archive_table_partition_by_month(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.archiver_config.partition_by_month = True
+
+    result = api.archive_table('publisher', [1])
+    assert result['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'p' ORDER BY relname;")
+        partitioned_tables = [row['relname'] for row in cursor.fetchall()]
+
+        cursor.execute("SELECT count(*) FROM pg_inherits WHERE inhparent = 'book_archive'::regclass;")
+        book_partitions_count = cursor.fetchone()[0]
+
+        cursor.execute('SELECT id, archived_at = CURRENT_DATE AS is_today FROM book_archive ORDER BY id;')
+        book_archive_rows = [dict(row) for row in cursor.fetchall()]
+    conn.close()
+
+    # the whole subtree is provisioned before archiving, with partitions of current and next month
+    assert partitioned_tables == ['author_book_archive', 'book_archive', 'publisher_archive']
+    assert book_partitions_count == 2
+    assert book_archive_rows == [{'id': 1, 'is_today': True}, {'id': 2, 'is_today': True}]
+
+    result = api.restore_table('publisher', [1])
+    assert result['restored_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+
+def test_replica(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    # test DB is used as replica (connection settings are taken from [db]), it isn't in recovery, so lag is 0
+    api.config.replica_config.enabled = True
+    api.config.replica_config.max_lag_ms = 1000
+    api.config.replica_config.archive_discovery = True
+    api.config.profiler_config.enabled = True
+    api.config.profiler_config.slow_query_ms = 0
+    api.config.profiler_config.explain_sample = 1
+
+    conn = get_replica_conn(api.config)
+    assert conn.readonly and conn.autocommit
+    assert get_replica_lag(conn) == 0
+    conn.close()
+
+    book_refs = api.get_rows_references('publisher', [1])[1]['book']['publisher_id']
+    assert [row['id'] for row in book_refs] == [1, 2]
+
+    # keys are discovered by read-only connection, rows are deleted by the primary one
+    result = api.archive_table('publisher', [1])
+    assert result['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+    profile = {(edge['table'], edge['statement']): edge for edge in result['profile']}
+    assert profile[('book', 'select_by_fk')]['rows'] == 2
+    assert 'actual time' in profile[('book', 'select_by_fk')]['explain']
+
+    # unavailable replica - primary is used
+    api.config.replica_config.port = 1
+    conn = get_replica_conn(api.config)
+    assert conn.info.port == 54321
+    conn.close()
+
+
+def test_archive_table_server_delete_rules(clean_db):
+    conn = get_db_conn(Config('config.test.ini'))
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE book_review (id serial PRIMARY KEY, book_id integer REFERENCES book (id) ON DELETE CASCADE);
+            CREATE TABLE book_tag (id serial PRIMARY KEY, book_id integer REFERENCES book (id) ON DELETE SET NULL);
+            INSERT INTO book_review (book_id) VALUES (1), (2), (3);
+            INSERT INTO book_tag (book_id) VALUES (1), (3);
+        """)
+
+    try:
+        api = PgGraphApi(config_path='config.test.ini')
+        assert api.get_table_references('book')['in_refs']['book_review'] == [
+            ForeignKey(pk_main='id', pk_ref='id', fk_ref='book_id', fk_name=ANY, delete_rule='CASCADE')
+        ]
+
+        # delete-only mode: book_review and book_tag are left to the server
+        api.config.archiver_config.to_archive = False
+        result = api.archive_table('publisher', [1])
+        assert result['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT book_id FROM book_review ORDER BY book_id;')
+            review_rows = [row['book_id'] for row in cursor.fetchall()]
+
+            cursor.execute('SELECT book_id FROM book_tag ORDER BY id;')
+            tag_rows = [row['book_id'] for row in cursor.fetchall()]
+
+        assert review_rows == [3]
+        assert tag_rows == [None, 3]
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute('DROP TABLE book_review, book_tag;')
+        conn.close()
+
+
+def test_archive_table_where(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.archiver_config.chunk_size = 2
+
+    progress = []
+    result = api.archive_table('book', where='publisher_id IN (1, 3)', on_chunk=progress.append)
+    assert result['deleted_rows'] == {'author_book': 6, 'book': 4}
+
+    # keyset pagination: 4 rows by 2 per chunk
+    assert [deleted_rows['book'] for deleted_rows in progress] == [2, 4]
+
+    result = api.archive_table('book', where='publisher_id IN (1, 3)')
+    assert result['deleted_rows'] == {}
+
+    # processed rows are forgotten after each root chunk
+    archiver = Archiver(get_db_conn(api.config), api.references, api.config)
+    archiver.archive_root('publisher', [(2, )])
+    archiver.conn.close()
+    assert archiver.deleted_rows == {'author_book': 2, 'book': 1, 'publisher': 1}
+    assert archiver.visited == {}
+
+    conn = get_db_conn(api.config)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id FROM book ORDER BY id;')
+        book_rows = [row['id'] for row in cursor.fetchall()]
+    conn.close()
+
+    assert book_rows == []
+
+
+def test_get_graph_profile(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.profiler_config.top = 2
+
+    profile = api.get_graph_profile()
+    assert set(profile['timings_ms']) == {
+        'get_catalog_state', 'get_all_tables', 'get_all_fk', 'get_all_pk', 'build_graph'
+    }
+    assert profile['memory_peak_kb'] > 0
+    assert (profile['tables'], profile['foreign_keys'], profile['edges'], profile['nested_nodes']) == (5, 4, 4, 2)
+    assert profile['top_tables'] == [
+        {'table': 'employee', 'referring_tables': 1, 'nested_nodes': 1},
+        {'table': 'publisher', 'referring_tables': 1, 'nested_nodes': 1},
+    ]
+
+    # peak of already running trace, reached before the build, isn't reported
+    tracemalloc.start()
+    try:
+        blob = bytearray(50 * 1024 * 1024)
+        del blob
+        assert api.get_graph_profile()['memory_peak_kb'] < 10 * 1024
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,14 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import pytest
+
+from pggraph.config import ArchiverConfig
+
+
+def test_archiver_config_commit_mode():
+    assert ArchiverConfig.from_dict({'commit_mode': 'chunk'}).commit_mode == 'chunk'
+
+    with pytest.raises(ValueError, match='Unknown commit_mode chunks'):
+        ArchiverConfig.from_dict({'commit_mode': 'chunks'})
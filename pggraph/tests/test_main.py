@@ -0,0 +1,38 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import json
+from argparse import Namespace
+from unittest.mock import ANY
+
+from pggraph.api import PgGraphApi
+from pggraph.main import write_ndjson
+from pggraph.utils.action_enum import ActionEnum
+
+
+def read_records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_ndjson_rows_references(clean_db, capsys):
+    api = PgGraphApi(config_path='config.test.ini')
+
+    write_ndjson(api, Namespace(action=ActionEnum.get_rows_references, table='publisher', ids=[1, 2]))
+    records = read_records(capsys)
+
+    assert sorted((record['id'], record['row_key']['id']) for record in records) == [(1, 1), (1, 2), (2, 3)]
+    assert records[0] == {'type': 'reference', 'id': ANY, 'table': 'book', 'fk': 'publisher_id', 'row_key': ANY}
+
+
+def test_ndjson_archive_table(clean_db, capsys):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.archiver_config.chunk_size = 1
+
+    write_ndjson(api, Namespace(action=ActionEnum.archive_table, table='publisher', ids=[1, 2], where=None))
+    records = read_records(capsys)
+
+    # progress after each chunk, then final stats
+    assert [record['type'] for record in records] == ['progress', 'progress', 'stats']
+    assert records[0]['deleted_rows'] == {'author_book': 4, 'book': 2, 'publisher': 1}
+    assert records[-1]['deleted_rows'] == {'author_book': 6, 'book': 3, 'publisher': 2}
@@ -0,0 +1,27 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+from pggraph.utils.reachability import ReachabilityIndex
+
+
+def test_reachability_index_cycles():
+    # a <- b <- c <- a (cycle of 3 tables), d refers to c, e is self-referencing
+    references = {
+        'a': {'b': {}},
+        'b': {'c': {}},
+        'c': {'a': {}, 'd': {}},
+        'd': {},
+        'e': {'e': {}},
+    }
+    index = ReachabilityIndex(references)
+
+    assert index.get_reachable_tables('a') == {'b': 1, 'c': 2, 'd': 3}
+    assert index.get_reachable_tables('d', direction='out') == {'c': 1, 'b': 2, 'a': 3}
+    assert index.is_reachable('c', 'b')
+    assert not index.is_reachable('d', 'a')
+    assert index.is_reachable('a', 'a') and index.is_reachable('e', 'e')
+    assert not index.is_reachable('d', 'd')
+
+    assert index.get_component('b') == ['a', 'b', 'c']
+    assert sorted(index.get_cycles()) == [['a', 'b', 'c'], ['e']]
@@ -0,0 +1,112 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+import json
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import urlopen, Request
+
+import pytest
+
+from pggraph.api import PgGraphApi
+from pggraph.db.base import get_db_conn
+from pggraph.server import PgGraphServer, JobManager
+
+
+@pytest.fixture
+def server(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    api.config.server_config.port = 0
+
+    server = PgGraphServer(api)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, path: str, data: dict = None):
+    host, port = server.server_address[:2]
+    body = json.dumps(data).encode() if data is not None else None
+    try:
+        with urlopen(Request(f'http://{host}:{port}{path}', data=body)) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_references(server):
+    status, result = request(server, '/tables/publisher/references')
+    assert status == 200
+    assert result['in_refs']['book'][0]['fk_ref'] == 'publisher_id'
+
+    status, result = request(server, '/tables/publisher/rows_references?ids=2,3')
+    assert status == 200
+    assert result == {
+        '2': {'book': {'publisher_id': [{'id': 3, 'publisher_id': 2}]}},
+        '3': {'book': {'publisher_id': [{'id': 4, 'publisher_id': 3}, {'id': 5, 'publisher_id': 3}]}},
+    }
+
+    status, result = request(server, '/tables/unknown/references')
+    assert status == 404
+
+
+def test_archive_job(server):
+    status, job = request(server, '/tables/publisher/archive', {'ids': [3]})
+    assert status == 202
+    assert job['status'] in ('queued', 'running')
+
+    for _ in range(100):
+        status, job = request(server, f"/jobs/{job['id']}")
+        if job['status'] not in ('queued', 'running'):
+            break
+        time.sleep(0.05)
+
+    assert job['status'] == 'done', job['error']
+    status, result = request(server, '/tables/publisher/rows_references?ids=3')
+    assert result == {'3': {'book': {'publisher_id': []}}}
+
+    status, result = request(server, '/tables/publisher/archive', {'ids': 'abc'})
+    assert status == 400
+
+
+def wait_jobs(job_manager, jobs):
+    for _ in range(200):
+        if all(job.status not in ('queued', 'running') for job in jobs):
+            break
+        time.sleep(0.05)
+
+
+def test_concurrent_jobs(clean_db):
+    api = PgGraphApi(config_path='config.test.ini')
+    job_manager = JobManager(api, api.config.server_config)
+    try:
+        # archive tables of the shared subtree (book, author_book) are created by one job only
+        jobs = [job_manager.submit('publisher', [1]), job_manager.submit('publisher', [3])]
+        wait_jobs(job_manager, jobs)
+        assert [job.status for job in jobs] == ['done', 'done'], [job.error for job in jobs]
+        assert jobs[1].result['deleted_rows'] == {'author_book': 2, 'book': 2, 'publisher': 1}
+
+        # tables created after start are archived by next job
+        conn = get_db_conn(api.config)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE book_note (id serial PRIMARY KEY, book_id integer REFERENCES book (id));
+                INSERT INTO book_note (book_id) VALUES (3);
+            """)
+
+        try:
+            job = job_manager.submit('publisher', [2])
+            wait_jobs(job_manager, [job])
+            assert job.status == 'done', job.error
+            assert job.result['deleted_rows'] == {'author_book': 2, 'book': 1, 'book_note': 1, 'publisher': 1}
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute('DROP TABLE book_note, book_note_archive;')
+            conn.close()
+    finally:
+        job_manager.shutdown()
@@ -9,6 +9,14 @@ class ActionEnum(Enum):
     archive_table = 'archive_table'
     get_table_references = 'get_table_references'
     get_rows_references = 'get_rows_references'
+    get_missing_fk_indexes = 'get_missing_fk_indexes'
+    serve = 'serve'
+    compile_archive_plan = 'compile_archive_plan'
+    archive_table_by_plan = 'archive_table_by_plan'
+    restore_table = 'restore_table'
+    get_reachable_tables = 'get_reachable_tables'
+    get_cycles = 'get_cycles'
+    get_graph_profile = 'get_graph_profile'
 
     @classmethod
     def list_values(cls):
@@ -11,4 +11,5 @@ class ForeignKey:
     pk_ref: str     # referring table Primary Key
     fk_ref: str     # referring table Foreign Key
     fk_name: str  # foreign key name
+    delete_rule: str = 'NO ACTION'  # ON DELETE action: NO ACTION, RESTRICT, CASCADE, SET NULL or SET DEFAULT
 
@@ -0,0 +1,13 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+from dataclasses import dataclass
+
+
+@dataclass
+class RowReference:
+    id: object      # Primary Key of the referenced row
+    table: str      # referring table
+    fk: str         # referring table Foreign Key
+    row_key: dict   # referring table Primary Key values of the referring row
@@ -0,0 +1,150 @@
+"""
+Copyright Ⓒ 2020 "Sberbank Real Estate Center" Limited Liability Company. Licensed under the MIT license.
+Please, see the LICENSE.md file in project's root for full licensing information.
+"""
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+DIRECTION_IN = 'in'     # tables referring to the table (directly or transitively), e.g. archived with it
+DIRECTION_OUT = 'out'   # tables referenced by the table (directly or transitively)
+DIRECTIONS = (DIRECTION_IN, DIRECTION_OUT)
+
+
+class ReachabilityIndex:
+    """
+    Reachability index of tables dependency graph in both directions.
+
+    Index is computed once, when the graph is built (or refreshed): strongly connected components (cycles)
+    and minimal depths of all reachable tables for each table in both directions (BFS from each table).
+    So reachability checks and depths lookups don't traverse the graph, at the cost of O(T * (T + E)) time
+    to build and memory for all reachable pairs of tables (T tables, E Foreign Keys between them).
+    """
+    edges: Dict[str, Dict[str, Set[str]]]
+    components: List[List[str]]
+    component_ids: Dict[str, int]
+    cyclic_components: Set[int]
+    depths: Dict[str, Dict[str, Dict[str, int]]]
+
+    def __init__(self, references: Dict[str, dict]):
+        self.edges = {DIRECTION_IN: {}, DIRECTION_OUT: {}}
+        for table_name, refs in references.items():
+            self.edges[DIRECTION_IN].setdefault(table_name, set()).update(refs)
+            self.edges[DIRECTION_OUT].setdefault(table_name, set())
+            for ref_table in refs:
+                self.edges[DIRECTION_IN].setdefault(ref_table, set())
+                self.edges[DIRECTION_OUT].setdefault(ref_table, set()).add(table_name)
+
+        self.components = get_strongly_connected_components(self.edges[DIRECTION_IN])
+        self.component_ids = {
+            table_name: i for i, component in enumerate(self.components) for table_name in component
+        }
+        self.cyclic_components = {
+            i for i, component in enumerate(self.components)
+            if len(component) > 1 or component[0] in self.edges[DIRECTION_IN][component[0]]
+        }
+        self.depths = {
+            direction: {table_name: get_depths(edges, table_name) for table_name in edges}
+            for direction, edges in self.edges.items()
+        }
+
+    def is_reachable(self, table_name: str, ref_table: str, direction: str = DIRECTION_IN) -> bool:
+        """%ref_table% refers to %table_name% (direction 'in') or is referenced by it (direction 'out') transitively"""
+        if table_name not in self.component_ids or ref_table not in self.component_ids:
+            return False
+        if table_name == ref_table:
+            return self.component_ids[table_name] in self.cyclic_components
+
+        return ref_table in self.depths[direction][table_name]
+
+    def get_reachable_tables(self, table_name: str, direction: str = DIRECTION_IN,
+                             max_depth: int = None) -> Dict[str, int]:
+        """Tables reachable from %table_name% in %direction% with minimal depth: {table_name: depth}"""
+        if direction not in DIRECTIONS:
+            raise ValueError(f'Unknown direction {direction} (should be one of {", ".join(DIRECTIONS)})')
+        if table_name not in self.component_ids:
+            return {}
+
+        depths = self.depths[direction][table_name]
+        if max_depth is None:
+            return dict(depths)
+
+        return {ref_table: depth for ref_table, depth in depths.items() if depth <= max_depth}
+
+    def get_component(self, table_name: str) -> List[str]:
+        """Tables in the same strongly connected component (referring to each other transitively)"""
+        return self.components[self.component_ids[table_name]]
+
+    def get_cycles(self) -> List[List[str]]:
+        """Strongly connected components with cycles (several tables or self-referencing table)"""
+        return [self.components[i] for i in sorted(self.cyclic_components)]
+
+
+def get_subtree_tables(references: Dict[str, dict], table_name: str) -> Set[str]:
+    """Get %table_name% and all tables referring to it directly or transitively"""
+    return {table_name, *get_depths(references, table_name)}
+
+
+def get_depths(edges: Dict[str, Iterable[str]], table_name: str) -> Dict[str, int]:
+    """
+    BFS from %table_name% by %edges% ({table_name: tables}, e.g. references):
+    {reachable_table: minimal depth} (the table itself is excluded)
+    """
+    depths = {table_name: 0}
+    queue = deque([table_name])
+    while queue:
+        current = queue.popleft()
+        for ref_table in edges.get(current, ()):
+            if ref_table not in depths:
+                depths[ref_table] = depths[current] + 1
+                queue.append(ref_table)
+
+    del depths[table_name]
+    return depths
+
+
+def get_strongly_connected_components(edges: Dict[str, Set[str]]) -> List[List[str]]:
+    """
+    Tarjan's algorithm (iterative, so deep graphs don't hit recursion limit).
+    Components are returned in reverse topological order (each component goes after all components it reaches)
+    """
+    index, low_links, on_stack = {}, {}, set()
+    stack, components = [], []
+
+    for start in sorted(edges):
+        if start in index:
+            continue
+
+        work = [(start, iter(sorted(edges[start])))]
+        index[start] = low_links[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+
+        while work:
+            table_name, children = work[-1]
+            child = next(children, None)
+            if child is not None:
+                if child not in index:
+                    index[child] = low_links[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(edges[child]))))
+                elif child in on_stack:
+                    low_links[table_name] = min(low_links[table_name], index[child])
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low_links[parent] = min(low_links[parent], low_links[table_name])
+
+            if low_links[table_name] == index[table_name]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == table_name:
+                        break
+                components.append(sorted(component))
+
+    return components